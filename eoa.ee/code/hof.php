@@ -1,12 +1,10 @@
 <?php namespace hof {	
 	function get_students($conn): array {
-		$sql = "SELECT person.id id, person.name name, COUNT(*) participations,
-				COUNT(CASE WHEN contestant.placement = 1 THEN 1 END) place1,
-				COUNT(CASE WHEN contestant.placement = 2 THEN 1 END) place2,
-				COUNT(CASE WHEN contestant.placement = 3 THEN 1 END) place3
-			FROM person INNER JOIN contestant ON contestant.person_id = person.id GROUP BY person.id
-			HAVING place1 + place2 + place3 > 0 OR participations >= 8
-			ORDER BY participations DESC, place1 + place2 + place3 DESC, place1 DESC, place2 DESC, place3 DESC;";
+		// person_stats is maintained by the import tools (kasulikud_koodid/summaries.py)
+		$sql = "SELECT person.id id, person.name name, st.participations, st.place1, st.place2, st.place3
+			FROM person_stats st INNER JOIN person ON person.id = st.person_id
+			WHERE st.podiums > 0 OR st.participations >= 8
+			ORDER BY st.participations DESC, st.podiums DESC, st.place1 DESC, st.place2 DESC, st.place3 DESC;";
 		$result = $conn->query($sql);
 		$students = array();
 		if ($result->num_rows > 0) {
@@ -1,11 +1,9 @@
 <?php namespace koolid {
 	
 	function get_schools($conn): array {
-		$sql = "SELECT school.name name, school.id id, count(*) participations, count(distinct contestant.person_id) students,
-				count(case when contestant.placement = 1 then 1 end) place1,
-				count(case when contestant.placement = 2 then 1 end) place2,
-				count(case when contestant.placement = 3 then 1 end) place3
-			FROM school INNER JOIN contestant ON contestant.school_id = school.id GROUP BY school.id
+		// school_stats is maintained by the import tools (kasulikud_koodid/summaries.py)
+		$sql = "SELECT school.name name, school.id id, st.participations, st.students, st.place1, st.place2, st.place3
+			FROM school_stats st INNER JOIN school ON school.id = st.school_id
 			ORDER BY participations DESC, place1 + place2 + place3 DESC, place1 DESC, place2 DESC, place3 DESC;";
 		$result = $conn->query($sql);
 		$nimed = array();
@@ -12,8 +12,41 @@ function name_by_id($conn, $n_id) {
 	return $name;
 }
 
+// The accented capitals of the Latin and Cyrillic letters the names use, and
+// what personclusters.foldName makes of them, for when intl is not installed
+const UNACCENTED_FROM = 'ÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜÝĀĂĄĆĈĊČĎĒĔĖĘĚĜĞĠĢĤĨĪĬĮİĴĶĹĻĽŃŅŇŌŎŐŔŖŘŚŜŞŠŢŤŨŪŬŮŰŲŴŶŸŹŻŽЀЁЃЇЌЍЎЙ';
+const UNACCENTED_TO = 'AAAAAACEEEEIIIINOOOOOUUUUYAAACCCCDEEEEEGGGGHIIIIIJKLLLNNNOOORRRSSSSTTUUUUUUWYYZZZЕЕГІКИУИ';
+
+// The words of a name folded like personclusters.foldName does for
+// person_search: upper case, without accents
+function search_words($name): array {
+	$folded = mb_strtoupper($name);
+	if (class_exists('\Normalizer')) {
+		$folded = preg_replace('/\p{Mn}+/u', '', \Normalizer::normalize($folded, \Normalizer::FORM_KD));
+	} else {
+		$folded = strtr($folded, array_combine(
+			preg_split('//u', UNACCENTED_FROM, -1, PREG_SPLIT_NO_EMPTY),
+			preg_split('//u', UNACCENTED_TO, -1, PREG_SPLIT_NO_EMPTY)));
+	}
+	return preg_split('/[^\p{L}\p{N}]+/u', $folded, -1, PREG_SPLIT_NO_EMPTY);
+}
+
+// person_search is maintained by the import tools (kasulikud_koodid/summaries.py):
+// every word of every name, folded by search_words. A person is found if each
+// word of the search begins a word of their name.
 function find_by_name($conn, $name): array {
-	$sql = "SELECT id, name FROM person WHERE name LIKE '%".$conn->real_escape_string($name)."%';";
+	$words = search_words($name);
+	if (count($words) > 0) {
+		// the longest words first, as they narrow it down the most
+		usort($words, function($a, $b) { return mb_strlen($b) - mb_strlen($a); });
+		$sql = "SELECT DISTINCT p.id, p.name FROM person p";
+		foreach (array_values(array_unique($words)) as $i => $word) {
+			$sql .= " JOIN person_search s$i ON s$i.person_id = p.id AND s$i.token LIKE '".$conn->real_escape_string($word)."%'";
+		}
+		$sql .= ";";
+	} else {
+		$sql = "SELECT id, name FROM person WHERE name LIKE '%".$conn->real_escape_string($name)."%';";
+	}
 	$result = $conn->query($sql);
 	$names = array();
 	if ($result->num_rows > 0) {
@@ -0,0 +1,551 @@
+"""
+Benchmarks of the import and the tools against a copy of the database seeded
+from one of the dumps in `backups/`.
+
+The copy is either a SQLite file (the default) or a local MySQL/MariaDB
+database given with --mysql, created with the credentials in
+credentials.json. The SQLite copy has the same tables and indexes, and the
+few MySQL-only constructs the tools use are translated on the fly: it counts
+the round-trips just like MySQL would, but its times are only comparable with
+each other.
+
+The dumps predate `contest.year` (they have `year_id` referencing `year`),
+so the column is added and filled from the year names while seeding, as are
+`school_alias` and the summary tables (see summaries.py).
+
+For each of the sizes, a subcontest with that many contestants is generated
+from the people and schools in the dump (and some new ones), then timed:
+  * parse: rowcsv.parseCsv of the subcontest written as CSV
+  * import, import_bulk: importoly.addContest without and with bulk
+  * delete: deletesubcontest, the same steps as with --gc
+  * schoolpicker_load, duplicatepicker_load: the queries the pickers load with
+  * clusters: personclusters.findClusters
+  * search_like, search_index: looking up people by the beginnings of words
+    of their names, with LIKE '%...%' (as name_search.php used to) and with
+    person_search (summaries.searchPeople)
+The results are appended to benchmark_results.jsonl (one line per step and
+size) with the git revision, and compared with the last other revision's.
+
+Examples:
+    python3 benchmark.py --sizes 100 1000 10000
+    python3 benchmark.py --mysql eoa_bench --dump ../backups/eoa30072020.sql
+"""
+
+import os
+import sys
+import io
+import re
+import ast
+import csv
+import json
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+
+import db
+import dumpfile
+import summaries
+import deletesubcontest
+import personclusters
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'csv'))
+import rowcsv
+import importoly
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DUMP = os.path.join(HERE, '..', 'backups', 'eoa18022021.sql')
+RESULTS_FILE = os.path.join(HERE, 'benchmark_results.jsonl')
+
+# not in the dumps, but used by the tools
+SCHOOL_ALIAS_DDL = """CREATE TABLE IF NOT EXISTS school_alias (
+  name varchar(64) NOT NULL,
+  correct int NOT NULL,
+  PRIMARY KEY (name),
+  KEY idx_school_alias_correct (correct)
+)"""
+
+# columns of the generated subcontests besides the special ones
+TASKS = ['1', '2', '3', '4', '5', '6', '7', 'Summa']
+
+"""
+Fix up the CREATE TABLE statements of a dump to match the current schema
+(the INSERTs then need to name their columns, see insertColumns)
+"""
+def migrateTable(name, statement):
+    if name == 'contest' and '\n  `year` ' not in statement:
+        statement = statement.replace('`year_id` int NOT NULL,', '`year_id` int DEFAULT NULL,\n  `year` int DEFAULT NULL,')
+    return statement
+
+"""
+Statements run after loading a dump, on both MySQL and SQLite
+"""
+MIGRATIONS = [
+    "UPDATE contest SET year = (SELECT SUBSTR(y.name, 1, 4) FROM year y WHERE y.id = contest.year_id) WHERE year IS NULL",
+    SCHOOL_ALIAS_DDL,
+]
+
+"""
+The columns of the rows of an INSERT of the dump: its own, or those of the
+table in the dump (`tables`, by name)
+"""
+def insertColumns(statement, name, tables):
+    columns = dumpfile.insertColumns(statement) or tables[name]
+    return '(' + ', '.join(f'`{c}`' for c in columns) + ')'
+
+"""
+MySQL's REGEXP_REPLACE for SQLite, for the patterns the tools use
+"""
+def regexpReplace(s, pattern, replacement):
+    if s is None:
+        return None
+    pattern = pattern.replace('[:alnum:]', r'^\W_').replace('[^^', '[')
+    return re.sub(pattern, replacement, s)
+
+"""
+CREATE TABLE and CREATE INDEX statements for SQLite from a MySQL CREATE TABLE
+"""
+def sqliteCreateTable(statement):
+    table = dumpfile.parseCreateTable(statement)
+    name = table['name']
+    columns = []
+    autoIncrement = False
+    for column, definition in table['columns']:
+        definition = re.sub(r"\s+(CHARACTER SET|COLLATE) \w+|\s+COMMENT '(?:[^'\\]|\\.|'')*'|\s+unsigned", '', definition, flags=re.IGNORECASE)
+        if 'AUTO_INCREMENT' in definition.upper():
+            definition = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+            autoIncrement = True
+        columns.append(f'`{column}` {definition}')
+    if table['primary'] and not autoIncrement:
+        columns.append('PRIMARY KEY (' + ', '.join(f'`{c}`' for c in table['primary']) + ')')
+    ifNotExists = 'IF NOT EXISTS ' if 'IF NOT EXISTS' in statement[:40] else ''
+    result = [f'CREATE TABLE {ifNotExists}`{name}` (\n  ' + ',\n  '.join(columns) + '\n)']
+    for key, unique, keyColumns in table['keys']:
+        # index names are per database in SQLite
+        result.append(f'CREATE {"UNIQUE " if unique else ""}INDEX {ifNotExists}`{name}_{key}` ON `{name}` (' +
+                      ', '.join(f'`{c}`' for c in keyColumns) + ')')
+    return result
+
+"""
+Translate a query of the tools for SQLite
+Returns a list of statements (a CREATE TABLE becomes several)
+"""
+def sqliteQuery(query, hasParams):
+    if re.match(r'\s*CREATE TABLE', query):
+        return sqliteCreateTable(query)
+    # summaries.tableType
+    if 'information_schema.tables' in query:
+        return ["SELECT CASE type WHEN 'view' THEN 'VIEW' ELSE 'BASE TABLE' END FROM sqlite_master WHERE name = ?"]
+    # DELETE f FROM contestant_field f JOIN ... WHERE ...
+    if m := re.match(r'\s*DELETE (\w+) FROM (\w+) (\w+) (.*)$', query, re.DOTALL):
+        if m[1] == m[3]:
+            query = f'DELETE FROM {m[2]} WHERE rowid IN (SELECT {m[3]}.rowid FROM {m[2]} {m[3]} {m[4]})'
+    # importoly.lookupIds; SQLite only has UTF-8
+    query = re.sub(r'CONVERT\((\S+) USING \w+\)', r'\1', query)
+    # importoly.valuesTable, as SQLite only allows 500 terms in a UNION
+    query = re.sub(r'SELECT %s AS v(?: UNION ALL SELECT %s AS v)*',
+                   lambda m: 'SELECT column1 AS v FROM (VALUES ' + ', '.join(['(%s)'] * m[0].count('%s')) + ')', query)
+    if hasParams:
+        query = query.replace('%s', '?')
+    return [query]
+
+class SqliteCursor:
+    """
+    A SQLite cursor used like a mysql.connector cursor
+    """
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, query, params = ()):
+        for q in sqliteQuery(query, bool(params)):
+            self.cur.execute(q, tuple(params))
+
+    def executemany(self, query, params):
+        query, = sqliteQuery(query, True)
+        self.cur.executemany(query, params)
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def __iter__(self):
+        return iter(self.cur)
+
+class SqliteConnection:
+    """
+    A SQLite database used like a mysql.connector connection (see db.Connection)
+    """
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.create_function('REGEXP_REPLACE', 3, regexpReplace, deterministic=True)
+        # SQLite's own only knows ASCII
+        self.conn.create_function('UPPER', 1, lambda s: None if s is None else str(s).upper(), deterministic=True)
+        # with MySQL's NULL handling
+        self.conn.create_function('CONCAT', -1, lambda *a: None if None in a else ''.join(map(str, a)), deterministic=True)
+        # SQLite only uses indexes for LIKE 'prefix%' when it is case
+        # sensitive; person_search is all uppercase anyway
+        self.conn.execute('PRAGMA case_sensitive_like = ON')
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+    def is_connected(self):
+        return True
+
+"""
+Create a fresh SQLite copy of a dump
+"""
+def seedSqlite(filename, dump):
+    if os.path.exists(filename):
+        os.remove(filename)
+    conn = SqliteConnection(filename)
+    cur = conn.conn.cursor()
+    tables = {}
+    views = {}
+    for kind, name, statement in dumpfile.read(dump):
+        if kind == 'table':
+            tables[name] = [c for c, _ in dumpfile.parseCreateTable(statement)['columns']]
+            for s in sqliteCreateTable(migrateTable(name, statement)):
+                cur.execute(s)
+        elif kind == 'rows':
+            rows = dumpfile.parseRows(statement)
+            first = next(rows, None)
+            if first is None:
+                continue
+            query = f'INSERT INTO `{name}` {insertColumns(statement, name, tables)} VALUES (' + ', '.join(['?'] * len(first)) + ')'
+            cur.execute(query, first)
+            cur.executemany(query, rows)
+        elif kind == 'view':
+            # the last definition is the real one
+            views[name] = statement
+    for name, select in views.items():
+        cur.execute(f'CREATE VIEW `{name}` AS {select}')
+    conn.commit()
+    return db.Connection(conn)
+
+"""
+Load a dump into a MySQL database (created if needed), replacing its tables
+"""
+def seedMysql(database, dump):
+    import mysql.connector
+    credentials = db.credentials()
+    if database == credentials['database']:
+        raise Exception(f'Refusing to overwrite the database the tools use ({database})')
+    server = mysql.connector.connect(**{k: v for k, v in credentials.items() if k != 'database'})
+    server.cursor().execute(f'CREATE DATABASE IF NOT EXISTS `{database}` CHARACTER SET utf8mb4')
+    server.close()
+
+    conn = db.Connection(mysql.connector.connect(**{**credentials, 'database': database}))
+    cur = conn.cursor()
+    tables = {}
+    for kind, name, statement in dumpfile.read(dump):
+        if kind == 'table':
+            tables[name] = [c for c, _ in dumpfile.parseCreateTable(statement)['columns']]
+            statement = migrateTable(name, statement)
+        elif kind == 'rows':
+            statement = statement.replace(f'INSERT INTO `{name}` VALUES', f'INSERT INTO `{name}` {insertColumns(statement, name, tables)} VALUES', 1)
+        elif kind == 'view':
+            statement = f'CREATE OR REPLACE VIEW `{name}` AS {statement}'
+        # the dump's view definer doesn't exist here
+        cur.execute(re.sub(r'/\*!50013 DEFINER=.*?\*/\n?', '', statement))
+    conn.commit()
+    return conn
+
+"""
+Bring a freshly seeded copy up to the current schema
+"""
+def migrate(conn):
+    cur = conn.cursor()
+    for statement in MIGRATIONS:
+        cur.execute(statement)
+    for rebuild in summaries.rebuilders.values():
+        rebuild(cur)
+    conn.commit()
+
+class StepStats(db.QueryStats):
+    """
+    Query statistics with running totals of a benchmark step, which clear()
+    (called by importoly after every contest) doesn't reset
+    """
+    def __init__(self):
+        super().__init__()
+        self.queries = 0
+        self.roundTrips = 0
+
+    def record(self, query, seconds, rows, roundTrips = 1):
+        super().record(query, seconds, rows, roundTrips)
+        self.queries += 1
+        self.roundTrips += roundTrips
+
+class Benchmark:
+    """
+    Runs the steps, collecting the wall times and round-trips of each
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        # (step, size) -> list of (seconds, queries, round-trips)
+        self.runs = {}
+
+    def measure(self, step, size, fn, *args):
+        stats = self.conn.stats = StepStats()
+        start = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - start
+        self.runs.setdefault((step, size), []).append((seconds, stats.queries, stats.roundTrips))
+        logging.info(f'{step} ({size}): {seconds:.3f} s, {stats.roundTrips} round-trips')
+        return result
+
+    def results(self, **extra):
+        for (step, size), runs in self.runs.items():
+            yield {**extra, 'step': step, 'size': size,
+                   'seconds': statistics.median(r[0] for r in runs),
+                   'min_seconds': min(r[0] for r in runs),
+                   'queries': runs[0][1], 'round_trips': runs[0][2], 'runs': len(runs)}
+
+"""
+Names of the people and schools of the dump, to draw the synthetic
+contestants from
+"""
+def existingNames(cur):
+    cur.execute('SELECT name FROM person ORDER BY id')
+    people = [name for name, in cur]
+    cur.execute('SELECT name FROM school ORDER BY id')
+    schools = [name for name, in cur]
+    return people, schools
+
+"""
+Write a CSV file of a subcontest with `size` contestants
+About a third of the contestants and mentors are new people, the rest (and
+all of the schools) exist already.
+"""
+def writeSubcontest(filename, size, people, schools, rng):
+    def person():
+        if rng.random() < 0.3 or not people:
+            return f'Sünteetiline {rng.randrange(10 ** 9)} Õpilane'
+        return rng.choice(people)
+
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Koht', 'Nimi', 'Kool', 'Klass', 'Juhendaja'] + TASKS)
+        for placement in range(1, size + 1):
+            points = [rng.randrange(11) for _ in TASKS[:-1]]
+            mentors = ', '.join(person() for _ in range(rng.choice((0, 1, 1, 2))))
+            writer.writerow([placement, person(), rng.choice(schools) if schools else '', rng.randrange(10, 13), mentors] +
+                            points + [sum(points)])
+
+def contestDict(name, subject, typeName, columns, contestants):
+    return {
+        'year': '2099',
+        'subject': subject,
+        'type': typeName,
+        'name': name,
+        'subcontests': [{
+            'name': 'Gümnaasium',
+            'class_range_name': 'gümnaasium',
+            'class_range': ('10', '12'),
+            'description': None,
+            'columns': columns,
+            'contestants': contestants,
+        }],
+    }
+
+"""
+Import a contest from scratch, as a freshly started tool would
+"""
+def importContest(contest, bulk):
+    importoly.row_cache.clear()
+    importoly.school_cache.clear()
+    importoly.cache_loaded = False
+    importoly.addContest(contest, bulk=bulk)
+
+"""
+Delete a contest and its subcontests like `deletesubcontest.py --contest ID --gc`
+"""
+def deleteContest(conn, name):
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM contest WHERE name = %s', (name,))
+    contestIds = [id for id, in cur]
+    subcontests, _, _ = deletesubcontest.findSubcontests(cur, [], contestIds)
+    ids = [sc[0] for sc in subcontests]
+    deletesubcontest.countRows(cur, ids)
+    people, schools = deletesubcontest.referencedIds(cur, ids)
+    orphanPeople, orphanSchools = deletesubcontest.orphans(cur, ids, people, schools)
+    conn.rollback()
+    # it reports its progress on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        deletesubcontest.deleteSubcontests(conn, cur, ids, contestIds = contestIds)
+    deletesubcontest.collectGarbage(conn, cur, orphanPeople, orphanSchools)
+
+"""
+The load query of a picker
+The pickers open their windows when imported, so it is read from the source.
+"""
+def pickerQuery(filename):
+    with open(os.path.join(HERE, filename)) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'LOAD_QUERY' for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise Exception(f'No LOAD_QUERY in {filename}')
+
+def loadAll(conn, query):
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    conn.rollback()
+    return rows
+
+def findClusters(conn):
+    clusters = personclusters.findClusters(conn.cursor())
+    conn.rollback()
+    return clusters
+
+"""
+Beginnings of words of random names, to search for
+"""
+def searchSample(people, rng, count = 50):
+    words = []
+    for name in rng.sample(people, min(count, len(people))):
+        words.append(rng.choice(name.split())[:4])
+    return words
+
+def searchLike(conn, words):
+    cur = conn.cursor()
+    for word in words:
+        cur.execute('SELECT id, name FROM person WHERE name LIKE %s', ('%' + word + '%',))
+        cur.fetchall()
+    conn.rollback()
+
+def searchIndex(conn, words):
+    cur = conn.cursor()
+    for word in words:
+        summaries.searchPeople(cur, word)
+    conn.rollback()
+
+def run(bench, conn, sizes, repeat, seed):
+    cur = conn.cursor()
+    people, schools = existingNames(cur)
+    cur.execute('SELECT name FROM subject ORDER BY id LIMIT 1')
+    subject, = cur.fetchone()
+    cur.execute('SELECT name FROM type ORDER BY id LIMIT 1')
+    typeName, = cur.fetchone()
+    conn.rollback()
+
+    queries = {'schoolpicker_load': pickerQuery('schoolpicker.py'),
+               'duplicatepicker_load': pickerQuery('duplicatepicker.py')}
+    rng = random.Random(seed)
+    words = searchSample(people, rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            filename = os.path.join(tmp, f'{size}.csv')
+            writeSubcontest(filename, size, people, schools, rng)
+            for r in range(repeat):
+                for step, bulk in (('import', False), ('import_bulk', True)):
+                    columns, contestants = bench.measure('parse', size, rowcsv.parseCsv, filename)
+                    name = f'Benchmark {size} {r} {step}'
+                    bench.measure(step, size, importContest, contestDict(name, subject, typeName, columns, contestants), bulk)
+                    if bulk:
+                        # with the subcontest in the database
+                        for loadStep, query in queries.items():
+                            bench.measure(loadStep, size, loadAll, conn, query)
+                        bench.measure('clusters', size, findClusters, conn)
+                        bench.measure('search_like', size, searchLike, conn, words)
+                        bench.measure('search_index', size, searchIndex, conn, words)
+                    bench.measure('delete', size, deleteContest, conn, name)
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+"""
+The results of the last revision other than `label` with the same backend
+and dump, by (step, size)
+"""
+def previousResults(filename, label, backend, dump):
+    previous = {}
+    try:
+        with open(filename) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return previous
+    lines = [l for l in lines if l['revision'] != label and l['backend'] == backend and l['dump'] == dump]
+    if lines:
+        last = lines[-1]['revision']
+        previous = {(l['step'], l['size']): l for l in lines if l['revision'] == last}
+    return previous
+
+def printResults(results, previous):
+    print(f"{'step':<22} {'size':>6} {'seconds':>9} {'change':>8} {'queries':>8} {'trips':>7} {'change':>8}")
+    for r in results:
+        p = previous.get((r['step'], r['size']))
+        timeChange = f"{(r['seconds'] / p['seconds'] - 1) * 100:+.0f}%" if p and p['seconds'] else ''
+        tripChange = f"{r['round_trips'] - p['round_trips']:+d}" if p else ''
+        print(f"{r['step']:<22} {r['size']:>6} {r['seconds']:>9.3f} {timeChange:>8} {r['queries']:>8} {r['round_trips']:>7} {tripChange:>8}")
+    if previous:
+        print(f"(changes relative to {next(iter(previous.values()))['revision']})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the import and the tools on a copy of a dump')
+    parser.add_argument('--dump', default=DEFAULT_DUMP, help='mysqldump file to seed the database from')
+    parser.add_argument('--mysql', metavar='DATABASE', help='Use this MySQL database (replacing its tables) instead of SQLite')
+    parser.add_argument('--sqlite', metavar='FILE', default=os.path.join(tempfile.gettempdir(), 'eoa_benchmark.sqlite'),
+                        help='SQLite file to use (replaced)')
+    parser.add_argument('-s', '--sizes', nargs='+', type=int, default=[100, 1000], help='Contestants per subcontest')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of each step and size')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic data')
+    parser.add_argument('--results', default=RESULTS_FILE, help='File to append the results to as JSON lines')
+    parser.add_argument('--label', default=None, help='Label of the results (default: the git revision)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    # importoly logs every query at DEBUG
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    backend = 'mysql' if args.mysql else 'sqlite'
+    start = time.perf_counter()
+    conn = seedMysql(args.mysql, args.dump) if args.mysql else seedSqlite(args.sqlite, args.dump)
+    migrate(conn)
+    print(f'Seeded from {args.dump} in {time.perf_counter() - start:.2f} s')
+
+    importoly.conn = conn
+    importoly.cur = conn.cursor()
+
+    bench = Benchmark(conn)
+    run(bench, conn, args.sizes, args.repeat, args.seed)
+    conn.close()
+
+    label = args.label or revision()
+    dump = os.path.basename(args.dump)
+    results = list(bench.results(revision=label, time=time.strftime('%Y-%m-%dT%H:%M:%S'), backend=backend, dump=dump))
+    previous = previousResults(args.results, label, backend, dump)
+    with open(args.results, 'a') as f:
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+    printResults(results, previous)
@@ -0,0 +1,174 @@
+"""
+Import many CSV files at once, without the GUI.
+
+Each file is parsed with `rowcsv.streamCsv` (so it needs a header row with the
+special columns, see `rowcsv.py`) and becomes one contest with one subcontest.
+The subject, type, class range and year are inferred from the file name with
+the same rules as in `interface2.py`; anything that can't be inferred (or is
+inferred wrong) has to be given on the command line, in which case it applies
+to all of the files.
+
+Files are checked in parallel, but imported one by one over a single
+connection, each file in its own transaction. While importing, a file is read
+again row by row, so that it is never in memory as a whole. With `--dry-run`
+every import is rolled back.
+
+Example:
+    python3 batchimport.py --year 2015 efo63/
+"""
+
+import argparse
+import glob
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import rowcsv
+import infer
+
+"""
+Expand the command line arguments (files, directories or globs) to a list of
+CSV files
+"""
+def findFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.csv")))
+        else:
+            files += sorted(glob.glob(path)) or [path]
+    return files
+
+"""
+Check a file and build the contest dictionary for importoly.addContest,
+without the contestants (see streamContestants)
+Runs in a worker process, so it must not touch the database.
+Returns (filename, contest, number of contestants, error)
+"""
+def prepareFile(filename, overrides):
+    try:
+        fields = infer.inferContestFields(os.path.basename(filename))
+        year = infer.inferYear(os.path.basename(filename))
+        if year is not None:
+            fields["year"] = year
+        fields.update({k: v for k, v in overrides.items() if v is not None})
+
+        for f in ("subject", "type", "year", "class_range"):
+            if f not in fields:
+                raise Exception(f'Could not infer "{f}"')
+
+        classRangeName, *classRange = re.split(r"[ ,]", fields["class_range"])
+        if len(classRange) != 2:
+            raise Exception(f'Invalid class range "{fields["class_range"]}"')
+
+        errors = []
+        columns, contestants = rowcsv.streamCsv(filename, errors)
+        count = sum(1 for _ in contestants)
+        if errors:
+            raise Exception(', '.join(f'line {line}: {msg}' for line, msg in errors))
+
+        subcontest = {
+            "name": fields.get("subcontest_name") or infer.subcontestName(classRangeName, *classRange),
+            "class_range_name": classRangeName,
+            "class_range": classRange,
+            "description": fields.get("description"),
+            "columns": columns,
+        }
+        contest = {
+            "year": fields["year"],
+            "subject": fields["subject"],
+            "type": fields["type"],
+            "name": fields.get("name") or infer.contestName(fields["subject"], fields["type"], fields["year"]),
+            "subcontests": [subcontest],
+        }
+        return filename, contest, count, None
+    except Exception as e:
+        return filename, None, 0, str(e)
+
+"""
+Add the contestants of an already checked file to its contest dictionary, as
+a generator reading the file (so they aren't sent between the processes)
+If the file has changed since and a row is invalid, the generator raises, so
+that the import fails instead of skipping the row.
+"""
+def streamContestants(filename, contest):
+    errors = []
+    _, contestants = rowcsv.streamCsv(filename, errors)
+
+    def checked():
+        for c in contestants:
+            if errors:
+                break
+            yield c
+        if errors:
+            raise Exception(', '.join(f'line {line}: {msg}' for line, msg in errors))
+
+    contest["subcontests"][0]["contestants"] = checked()
+
+def main():
+    parser = argparse.ArgumentParser(description="Import CSV files into the database")
+    parser.add_argument("paths", nargs="+", help="CSV files, directories or globs")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Roll back every import")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of parser processes")
+    parser.add_argument("--year", help="Starting year of the school year, e.g. 2019 for 2019/2020")
+    parser.add_argument("--subject")
+    parser.add_argument("--type")
+    parser.add_argument("--class-range", help='e.g. "gümnaasium,10,12"')
+    parser.add_argument("--name", help="Contest name")
+    parser.add_argument("--subcontest-name")
+    parser.add_argument("--description")
+    parser.add_argument("--query-log", metavar="FILE", help="Append the query statistics of every file to FILE as JSON lines")
+    parser.add_argument("--cache-snapshot", metavar="FILE", nargs="?", const="",
+                        help="Keep the lookup cache in FILE between runs, useful for repeated dry runs (default: lookup_cache.pickle)")
+    args = parser.parse_args()
+
+    overrides = {
+        "year": args.year,
+        "subject": args.subject,
+        "type": args.type,
+        "class_range": args.class_range,
+        "name": args.name,
+        "subcontest_name": args.subcontest_name,
+        "description": args.description,
+    }
+
+    files = findFiles(args.paths)
+    if not files:
+        print("No files found")
+        return 1
+
+    # only the main process uses the database
+    import importoly
+    importoly.query_log = args.query_log
+    if args.cache_snapshot is not None:
+        importoly.cache_snapshot = args.cache_snapshot or importoly.DEFAULT_CACHE_SNAPSHOT
+
+    results = []
+    with ProcessPoolExecutor(args.jobs) as pool:
+        for filename, contest, count, error in pool.map(prepareFile, files, [overrides] * len(files)):
+            if error is not None:
+                logging.error(f"{filename}: {error}")
+                results.append((filename, "parse error", 0, error))
+                continue
+
+            try:
+                streamContestants(filename, contest)
+                importoly.addContest(contest, dryRun = args.dry_run, bulk = True)
+                results.append((filename, "dry run ok" if args.dry_run else "imported", count, ""))
+            except Exception as e:
+                # addContest has already logged the actual exception
+                results.append((filename, "import error", count, str(e.__context__ or e)))
+
+    # Summary
+    width = max(len(r[0]) for r in results)
+    print()
+    for filename, status, count, error in results:
+        print(f"{filename.ljust(width)}  {status.ljust(12)}  {str(count).rjust(5)}  {error}")
+    failed = sum(1 for r in results if r[1].endswith("error"))
+    print(f"{len(results) - failed}/{len(results)} files OK, {sum(r[2] for r in results if not r[1].endswith('error'))} contestants")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
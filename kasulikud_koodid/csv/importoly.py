@@ -11,21 +11,23 @@ with contest and subcontest identifiers (year, subject, type, age group, name).
 """
 
 import os
-import json
-import mysql.connector
+import sys
+import pickle
+import unicodedata
+from itertools import islice
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
+# the connections and summary tables are shared with the tools in the parent
+# directory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import db
+import summaries
 
-# Credentials
-with open(os.path.join(os.path.dirname(__file__),"../credentials.json")) as f:
-    config = json.loads(f.read())
-mysql_user = config["user"]
-mysql_passwd = config["password"]
-mysql_db = config["database"]
-mysql_host = config["host"]
+logging.basicConfig(level=logging.DEBUG)
 
-conn = mysql.connector.connect(user=mysql_user, password=mysql_passwd, database=mysql_db, host=mysql_host)
+# connects on the first query, so importing this module doesn't wait for
+# the database
+conn = db.connection()
 cur = conn.cursor()
 
 logging.info('Running!')
@@ -36,6 +38,28 @@ def info(msg):
 def debug(msg):
     logging.debug(msg)
 
+"""
+Raised (and the transaction rolled back) when an import is cancelled
+"""
+class Cancelled(Exception):
+    pass
+
+"""
+Stop if the import has been cancelled (`cancel` being e.g. a threading.Event)
+"""
+def checkCancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+"""
+Report the number of contestants added so far, and stop if the import has
+been cancelled
+"""
+def reportProgress(progress, cancel, count):
+    if progress is not None:
+        progress(count)
+    checkCancelled(cancel)
+
 def execute(query, params):
     debug('Query: "' + query + '" ' + str(params))
     cur.execute(query, params)
@@ -48,11 +72,22 @@ NOTE: use getMakeRow, as otherwise duplicates might be created
 def createRow(table, **params):
     paramsList = [(k, v) for k, v in params.items()]
     execute(f"INSERT INTO {table} (" + ', '.join((p[0] for p in paramsList)) + ") VALUES (" + ', '.join(['%s'] * len(paramsList)) + ")", tuple(p[1] for p in paramsList))
+    if table == 'person':
+        new_people[cur.lastrowid] = params['name']
     return cur.lastrowid
 
 # cache to prevent re-doing SELECTs on the same age_groups and schools all the time
 row_cache = {}
 
+# ids of the cached rows (see row_cache and school_cache) created in the
+# current transaction, by table
+# on rollback, only the cache entries pointing to these are dropped
+created_ids = {}
+
+# people created since the last refreshSummaries (id -> name), to be added
+# to the search index
+new_people = {}
+
 """
 Get the id of a row in a table based on parameters
 Insert that row if it does not exist
@@ -74,6 +109,7 @@ def getMakeRow(table, getId = True, **params):
 
     # Otherwise create that row
     result = createRow(table, **params)
+    created_ids.setdefault(table, set()).add(result)
     row_cache[(table, *paramsList)] = result
     return result
 
@@ -91,9 +127,243 @@ def getSchoolId(name: str):
         school_cache[name] = id
         return id
     res = createRow("school", name = name)
+    created_ids.setdefault("school", set()).add(res)
     school_cache[name] = res
     return res
 
+# the character set of the tables (see the dumps), which the values of the
+# batched lookups are converted to, so that they are compared with the
+# collation of the column and can use its index
+TABLE_CHARSET = 'utf8'
+
+"""
+Build a derived table (with a single column `v`) out of the given values, to
+be joined against in batched lookups (see lookupIds). Unlike `IN (...)`, this
+keeps the original values in the result.
+"""
+def valuesTable(values):
+    return '(' + ' UNION ALL '.join(['SELECT %s AS v'] * len(values)) + ')'
+
+"""
+Get the ids of the rows in a table whose `column` matches one of the values,
+as compared by the collation of the column (like getMakeRow's WHERE does)
+Returns a dictionary from value to id, without inserting anything
+"""
+def lookupIds(table, column, values, idColumn = 'id'):
+    ids = {}
+    if not values:
+        return ids
+    execute(f"SELECT v.v, t.{idColumn} FROM {valuesTable(values)} v JOIN {table} t ON t.{column} = CONVERT(v.v USING {TABLE_CHARSET}) ORDER BY t.{idColumn}", tuple(values))
+    for v, id in cur:
+        ids.setdefault(v, id)
+    return ids
+
+"""
+Insert multiple rows into a table with a single multi-row INSERT
+"""
+def insertRows(table, columns, rows):
+    query = f"INSERT INTO {table} (" + ', '.join(columns) + ") VALUES (" + ', '.join(['%s'] * len(columns)) + ")"
+    debug('Query (executemany): "' + query + '" (' + str(len(rows)) + ' rows)')
+    cur.executemany(query, rows)
+
+"""
+Approximately how the database collation (case and accent insensitive,
+ignoring trailing spaces) compares names
+"""
+def collationKey(value):
+    s = unicodedata.normalize('NFKD', value.casefold())
+    return ''.join(c for c in s if not unicodedata.combining(c)).rstrip(' ')
+
+"""
+Insert the values missing from a table, and get the ids of their rows
+Spellings that the database considers equal (e.g. "Mari Tamm" and "MARI TAMM")
+get a single row, as getMakeRow would have found the first one when adding
+the second. Anything that collationKey groups differently from the database
+is inserted in another round. An inserted value that can't be found (e.g.
+one that was truncated to fit the column) is an error.
+Returns a dictionary from each of the values to the id of its row
+"""
+def insertMissing(table, column, values):
+    found = {}
+    while values:
+        unique = {}
+        for v in values:
+            unique.setdefault(collationKey(v), v)
+        insertRows(table, (column,), [(v,) for v in unique.values()])
+        found.update(lookupIds(table, column, values))
+        # every round finds at least the rows it inserted, so it ends
+        lost = [v for v in unique.values() if v not in found]
+        if lost:
+            raise Exception(f'could not find the inserted {table} rows of {lost[:5]}')
+        values = [v for v in values if v not in found]
+    created_ids.setdefault(table, set()).update(found.values())
+    return found
+
+"""
+Batch version of getMakeRow for rows identified by a single column
+Returns a dictionary from each of the values to the id of its row, inserting
+the missing rows in one go
+"""
+def getMakeRows(table, column, values):
+    ids = {}
+    toFind = []
+    for v in set(values):
+        if (table, (column, v)) in row_cache:
+            ids[v] = row_cache[(table, (column, v))]
+        else:
+            toFind.append(v)
+
+    found = lookupIds(table, column, toFind)
+    missing = [v for v in toFind if v not in found]
+    if missing:
+        inserted = insertMissing(table, column, missing)
+        if table == 'person':
+            new_people.update((id, v) for v, id in inserted.items())
+        found.update(inserted)
+
+    for v, id in found.items():
+        row_cache[(table, (column, v))] = id
+    ids.update(found)
+    return ids
+
+"""
+Batch version of getSchoolId
+"""
+def getSchoolIds(names):
+    ids = {}
+    toFind = []
+    for name in set(names):
+        if name in school_cache:
+            ids[name] = school_cache[name]
+        else:
+            toFind.append(name)
+
+    found = lookupIds('school_alias', 'name', toFind, idColumn = 'correct')
+    remaining = [name for name in toFind if name not in found]
+    found.update(lookupIds('school', 'name', remaining))
+    missing = [name for name in remaining if name not in found]
+    if missing:
+        found.update(insertMissing('school', 'name', missing))
+
+    school_cache.update(found)
+    ids.update(found)
+    return ids
+
+# tables that loadCache reads and whose checksums make up the snapshot watermark
+cached_tables = ('person', 'type', 'subject', 'age_group', 'school', 'school_alias')
+
+# file to keep the lookup cache in between runs (see loadCache), None to
+# always load it from the database
+# Checking whether the snapshot is still valid reads all of the cached tables,
+# and any import invalidates it, so it is only worth it for e.g. repeated dry
+# runs of the same files.
+cache_snapshot = None
+
+# where the tools put the snapshot when asked to
+DEFAULT_CACHE_SNAPSHOT = os.path.join(os.path.dirname(__file__), "lookup_cache.pickle")
+cache_loaded = False
+
+"""
+Get a watermark that changes whenever any of the cached tables changes
+"""
+def cacheWatermark():
+    execute("CHECKSUM TABLE " + ', '.join(cached_tables), ())
+    return tuple((table.split('.')[-1], checksum) for table, checksum in cur)
+
+"""
+Fill row_cache and school_cache with every person, type, subject, age group
+and school, so that getMakeRow and getSchoolId only need to query the
+database for rows that don't exist yet.
+
+If a snapshot file is given, the caches are read from it instead when its
+watermark still matches the database, and written to it otherwise. Imports
+change the watermark, so the snapshot only helps when nothing has been
+imported since it was written (e.g. after a dry run); it is not rewritten
+after every import, as that would checksum the tables every time.
+"""
+def loadCache(snapshot = None):
+    global cache_loaded
+    watermark = cacheWatermark() if snapshot is not None else None
+    if snapshot is not None and os.path.exists(snapshot):
+        try:
+            with open(snapshot, 'rb') as f:
+                saved = pickle.load(f)
+            if saved['watermark'] == watermark:
+                row_cache.update(saved['row_cache'])
+                school_cache.update(saved['school_cache'])
+                cache_loaded = True
+                info('Lookup cache loaded from ' + snapshot)
+                return
+        except Exception:
+            logging.exception('Could not read the lookup cache snapshot')
+
+    # setdefault, as getMakeRow would also get the first matching row
+    for table in ('person', 'type', 'subject'):
+        execute(f"SELECT name, id FROM {table} ORDER BY id", ())
+        for name, id in cur:
+            row_cache.setdefault((table, ('name', name)), id)
+
+    execute("SELECT id, name, min_class, max_class FROM age_group ORDER BY id", ())
+    for id, name, minClass, maxClass in cur:
+        minClass = None if minClass is None else str(minClass)
+        maxClass = None if maxClass is None else str(maxClass)
+        row_cache.setdefault(('age_group', ('min_class', minClass), ('max_class', maxClass)), id)
+        row_cache.setdefault(('age_group', ('name', name), ('min_class', minClass), ('max_class', maxClass)), id)
+
+    execute("SELECT name, id FROM school ORDER BY id", ())
+    for name, id in cur:
+        school_cache.setdefault(name, id)
+    # aliases take precedence, same as in getSchoolId
+    execute("SELECT name, correct FROM school_alias", ())
+    for name, id in cur:
+        school_cache[name] = id
+
+    cache_loaded = True
+    info(f'Lookup cache loaded ({len(row_cache)} rows, {len(school_cache)} schools)')
+    if snapshot is not None:
+        saveCache(snapshot, watermark)
+
+"""
+Write the caches, as loaded from the database with the given watermark (taken
+before loading them, so that changes made meanwhile invalidate the snapshot),
+to a snapshot file
+The snapshot is only an optimization, so failing to write it is not an error
+"""
+def saveCache(snapshot, watermark):
+    try:
+        with open(snapshot, 'wb') as f:
+            pickle.dump({'watermark': watermark, 'row_cache': row_cache, 'school_cache': school_cache}, f)
+    except Exception:
+        logging.exception('Could not write the lookup cache snapshot')
+
+"""
+Forget everything cached, so that it is loaded again before the next import
+"""
+def resetCache():
+    global cache_loaded
+    row_cache.clear()
+    school_cache.clear()
+    created_ids.clear()
+    cache_loaded = False
+
+"""
+Forget the rows created in the current transaction after a commit
+"""
+def commitCache():
+    created_ids.clear()
+
+"""
+Drop the cache entries pointing to rows created in the rolled back transaction
+"""
+def rollbackCache():
+    for key in [k for k, id in row_cache.items() if id in created_ids.get(k[0], ())]:
+        del row_cache[key]
+    createdSchools = created_ids.get('school', ())
+    for name in [n for n, id in school_cache.items() if id in createdSchools]:
+        del school_cache[name]
+    created_ids.clear()
+    new_people.clear()
+
 """
 Add a contestant
 Expects a dictionary containing:
@@ -148,6 +418,70 @@ def addContestant(contestant, subcontestId, columnIds):
         mentorsToInsert.append((str(contestantId), str(m)))
     return fieldsToInsert, mentorsToInsert
 
+# number of contestants added at once by addContestantsBulk
+bulk_chunk_size = 1000
+
+"""
+Add a chunk of contestants of a subcontest at once
+Expects the same dictionaries as addContestant, the subcontest's id, the
+columns' ids, the largest contestant id of the subcontest added so far and
+optionally a cancel flag, checked between the statements (see checkCancelled).
+Instead of querying the people, schools and age groups one contestant at a
+time, all distinct values are resolved together and the contestants, their
+fields and mentors are inserted with multi-row INSERTs, so the number of
+queries does not depend on the number of contestants.
+
+Returns the largest contestant id added
+"""
+def addContestantsBulk(contestants, subcontestId, columnIds, afterId = 0, cancel = None):
+    if not contestants:
+        return afterId
+
+    # Age groups: there are only a handful of different classes, getMakeRow
+    # (and its cache) handles them just fine
+    ageGroupIds = {}
+    for c in set(c['class'] for c in contestants):
+        if c is not None and c != '':
+            ageGroupIds[c] = str(getMakeRow('age_group', min_class = c, max_class = c))
+
+    personIds = getMakeRows('person', 'name', [c['name'] for c in contestants] +
+                            [m for c in contestants for m in c['instructors']])
+    schoolIds = getSchoolIds([c['school'] for c in contestants
+                              if c['school'] is not None and c['school'] != ''])
+    checkCancelled(cancel)
+
+    insertRows('contestant', ('subcontest_id', 'person_id', 'age_group_id', 'school_id', 'placement'), [
+        (str(subcontestId),
+         str(personIds[c['name']]),
+         ageGroupIds.get(c['class']),
+         schoolIds.get(c['school']),
+         c['placement'].strip() or None if c['placement'] else None)
+        for c in contestants])
+
+    # The subcontest was created in this transaction, so its contestants after
+    # the previous chunk are exactly the ones just inserted (in the same order)
+    execute("SELECT id FROM contestant WHERE subcontest_id = %s AND id > %s ORDER BY id", (str(subcontestId), str(afterId)))
+    contestantIds = [id for id, in cur]
+    if len(contestantIds) != len(contestants):
+        raise Exception("could not get the ids of the inserted contestants")
+    checkCancelled(cancel)
+
+    fieldsToInsert = []
+    mentorsToInsert = []
+    for contestant, contestantId in zip(contestants, contestantIds):
+        for c, v in zip(columnIds, contestant['fields']):
+            # (task_id, contestant_id, entry)
+            fieldsToInsert.append((str(c), str(contestantId), str(v) if v is not None else None))
+        for m in contestant['instructors']:
+            # (contestant_id, mentor_id)
+            mentorsToInsert.append((str(contestantId), str(personIds[m])))
+    if fieldsToInsert:
+        insertRows('contestant_field', ('task_id', 'contestant_id', 'entry'), fieldsToInsert)
+        checkCancelled(cancel)
+    if mentorsToInsert:
+        insertRows('mentor', ('contestant_id', 'mentor_id'), mentorsToInsert)
+    return contestantIds[-1]
+
 
 """
 Add a subcontest
@@ -156,10 +490,13 @@ Expects a dictionary containing:
   * 'class_range'
   * class_range_name
   * 'columns'
-  * 'contestants'
-and the parent contest's id
+  * 'contestants' (any iterable, it is only read once)
+, the parent contest's id, whether to add the contestants in bulk and
+optionally a progress callback and cancel flag (see reportProgress)
+
+Returns the number of contestants added
 """
-def addSubcontest(subcontest, contestId):
+def addSubcontest(subcontest, contestId, bulk = False, progress = None, cancel = None):
     # Get age group
     ageGroupId = getMakeRow('age_group',
                        name = subcontest['class_range_name'],
@@ -184,22 +521,86 @@ def addSubcontest(subcontest, contestId):
                              name = c,
                              seq_no = i))
 
-    fieldsToInsert = []
-    mentorsToInsert = []
-    # Create contestants
-    for c in subcontest['contestants']:
-        res = addContestant(c, subcontestId, columns)
-        fieldsToInsert += res[0]
-        mentorsToInsert += res[1]
-    if fieldsToInsert:
-        query = "INSERT INTO contestant_field (task_id, contestant_id, entry) VALUES (%s, %s, %s)"
-        debug('Query (executemany): "' + query + '" ' + str(fieldsToInsert))
-        cur.executemany(query, fieldsToInsert)
-    if mentorsToInsert:
-        query = "INSERT INTO mentor (contestant_id, mentor_id) VALUES (%s, %s)"
-        debug('Query (executemany): "' + query + '" ' + str(mentorsToInsert))
-        cur.executemany(query, mentorsToInsert)
+    added = 0
+    if bulk:
+        # Create contestants in chunks, so that a generator (see
+        # rowcsv.streamCsv) never has to be read into memory as a whole
+        contestants = iter(subcontest['contestants'])
+        lastId = 0
+        while chunk := list(islice(contestants, bulk_chunk_size)):
+            lastId = addContestantsBulk(chunk, subcontestId, columns, lastId, cancel)
+            added += len(chunk)
+            reportProgress(progress, cancel, added)
+    else:
+        fieldsToInsert = []
+        mentorsToInsert = []
+        # Create contestants
+        for c in subcontest['contestants']:
+            res = addContestant(c, subcontestId, columns)
+            fieldsToInsert += res[0]
+            mentorsToInsert += res[1]
+            added += 1
+            reportProgress(progress, cancel, added)
+        if fieldsToInsert:
+            insertRows('contestant_field', ('task_id', 'contestant_id', 'entry'), fieldsToInsert)
+        if mentorsToInsert:
+            insertRows('mentor', ('contestant_id', 'mentor_id'), mentorsToInsert)
+
+    refreshSummaries(subcontestId)
+    return added
+
+"""
+Update the summary tables (see summaries.py) for a newly added subcontest,
+and add the people created for it to the search index
+"""
+def refreshSummaries(subcontestId):
+    summaries.indexPeople(cur, new_people)
+    new_people.clear()
+    summaries.refreshSchoolStats(cur, summaries.subcontestSchoolIds(cur, [subcontestId]))
+    summaries.refreshPersonStats(cur, summaries.subcontestPersonIds(cur, [subcontestId]))
+    summaries.refreshFullSubcontest(cur, [subcontestId])
+
 
+# file to append the query statistics of each contest to as JSON lines (see
+# db.QueryStats), None to only log them
+query_log = None
+
+"""
+Log the statistics of the queries made since the last call
+"""
+def reportQueries(contestName):
+    info(f'Queries for "{contestName}":\n' + conn.stats.format())
+    if query_log is not None:
+        try:
+            conn.stats.writeJson(query_log, contest=contestName)
+        except Exception:
+            logging.exception('Could not write the query statistics')
+    conn.stats.clear()
+
+# MySQL error for a foreign key pointing to a row that doesn't exist
+ER_NO_REFERENCED_ROW = 1452
+
+def insertContest(contest, bulk, progress, cancel):
+    if not cache_loaded:
+        loadCache(cache_snapshot)
+
+    # Get parameters
+    typeId = getMakeRow('type', name = contest['type'])
+    subjectId = getMakeRow('subject', name = contest['subject'])
+    # Create contest
+    # todo should actually not be getMakeRow.... want year+type_id+subject_id to be unique
+    contestId = getMakeRow('contest',
+                          year = contest["year"],
+                          type_id = typeId,
+                          subject_id = subjectId,
+                          name = contest['name'])
+
+    # Create subcontests
+    added = 0
+    for sc in contest['subcontests']:
+        scProgress = None if progress is None else lambda n, before=added: progress(before + n)
+        added += addSubcontest(sc, contestId, bulk, scProgress, cancel)
+    return added
 
 """
 Add a contest
@@ -210,35 +611,47 @@ Expects a dictionary containing:
   * 'name'
   * 'subcontests'
 
-Additionally, whether to perform a "dry run" (rollback)
+Additionally, whether to perform a "dry run" (rollback), whether to add
+the contestants in bulk (see addContestantsBulk), a callback that gets the
+number of contestants added so far and a flag (e.g. threading.Event) that
+cancels the import when set. A cancelled import is rolled back and raises
+Cancelled.
+
+The cache can point to people or schools that have since been merged away
+(by schoolpicker or duplicatepicker). Then the cache is loaded again, and the
+import retried if its contestants are lists (a generator can only be read
+once, so otherwise the import fails and has to be run again).
 """
-def addContest(contest, dryRun = False):
+def addContest(contest, dryRun = False, bulk = False, progress = None, cancel = None):
     try:
-        # Get parameters
-        typeId = getMakeRow('type', name = contest['type'])
-        subjectId = getMakeRow('subject', name = contest['subject'])
-        # Create contest
-        # todo should actually not be getMakeRow.... want year+type_id+subject_id to be unique
-        contestId = getMakeRow('contest',
-                              year = contest["year"],
-                              type_id = typeId,
-                              subject_id = subjectId,
-                              name = contest['name'])
-
-        # Create subcontests
-        for sc in contest['subcontests']:
-            addSubcontest(sc, contestId)
+        try:
+            insertContest(contest, bulk, progress, cancel)
+        except Exception as e:
+            if getattr(e, 'errno', None) != ER_NO_REFERENCED_ROW:
+                raise
+            conn.rollback()
+            resetCache()
+            if not all(isinstance(sc['contestants'], (list, tuple)) for sc in contest['subcontests']):
+                raise
+            info('The lookup cache is out of date, retrying with a new one')
+            insertContest(contest, bulk, progress, cancel)
 
         if dryRun:
             conn.rollback()
+            rollbackCache()
             info("Contest added (dry run)")
         else:
             conn.commit()
+            commitCache()
             info("Contest added")
     except Exception as e:
         conn.rollback()
-        row_cache.clear()
-        school_cache.clear()
+        rollbackCache()
+        if isinstance(e, Cancelled):
+            info("Import cancelled")
+            raise
         logging.exception(e)
         raise Exception()
+    finally:
+        reportQueries(contest['name'])
 
@@ -0,0 +1,104 @@
+"""
+Rules for inferring contest information from a file name and special columns
+from the header row. Shared by the editor (`interface2.py`) and the batch
+importer (`batchimport.py`).
+"""
+
+import re
+
+inferContest = {
+    "subject": [
+        {"pattern": "efo|fyysika|füüsika|fys", "value": "Füüsika"},
+        {"pattern": "emo|mat|lvs|lvt", "value": "Matemaatika"},
+        {"pattern": "eko|keemia", "value": "Keemia"},
+        {"pattern": "inf", "value": "Informaatika"},
+        {"pattern": "ego", "value": "Geograafia"},
+        {"pattern": "ebo", "value": "Bioloogia"},
+    ],
+    "type": [
+        {"pattern": "lv[0-9st]", "value": "Lahtine"},
+        {"pattern": "lv", "value": "Lõppvoor"},
+        {"pattern": "lah", "value": "Lahtine"},
+    ],
+    "class_range": [
+        {"pattern": "(^|[^1-9])6k", "value": "6,6,6"},
+        {"pattern": "(^|[^1-9])7k", "value": "7,7,7"},
+        {"pattern": "(^|[^1-9])8k", "value": "8,8,8"},
+        {"pattern": "(^|[^1-9])9k", "value": "9,9,9"},
+        {"pattern": "10k", "value": "10,10,10"},
+        {"pattern": "11k", "value": "11,11,11"},
+        {"pattern": "12k", "value": "12,12,12"},
+        {"pattern": "(^|[-_ ])g($|[-_.])", "value": "gümnaasium,10,12"},
+        {"pattern": "(^|[-_ ])pk?($|[-_.])", "value": "põhikool,8,9"},
+        {"pattern": "(^|[-_ ])v($|[-_.])", "value": "vanem,11,12"},
+        {"pattern": "(^|[-_ ])n($|[-_.])", "value": "noorem,9,10"},
+    ]
+}
+
+inferColumns = [
+    {"pattern": r"(jrk|koht)\.?", "value": "placement"},
+    {"pattern": r".*eesnimi", "value": "first name"},
+    {"pattern": r".*pere(konna)?nimi", "value": "last name"},
+    {"pattern": r"(õpilane|(õpilase )?nimi)\.?", "value": "name"},
+    {"pattern": r"kool\.?", "value": "school"},
+    {"pattern": r"kl(ass)?\.?", "value": "class"},
+    {"pattern": r".*(juhendajad?|õp(etaja)?).*", "value": "instructors"},
+    {"pattern": r".*kokku.*", "value": "total"},
+]
+
+# Genitive forms of the age group names, for subcontest names
+ageGroupNames = {
+    "gümnaasium": "Gümnaasiumi",
+    "põhikool": "Põhikooli",
+    "vanem": "Vanema rühma",
+    "noorem": "Noorema rühma",
+}
+
+"""
+Infer the contest fields (subject, type, class range) from a file name
+Returns a dictionary with only the fields that matched
+"""
+def inferContestFields(filename):
+    fields = {}
+    for fieldName, patterns in inferContest.items():
+        for pattern in patterns:
+            if re.search(pattern["pattern"], filename, re.IGNORECASE):
+                fields[fieldName] = pattern["value"]
+                break
+    return fields
+
+"""
+Infer the (starting) year of the school year from a file name, e.g. 2019
+from "efo2019-20.csv"
+"""
+def inferYear(filename):
+    m = re.search(r"(?:^|\D)(\d{4})\D(\d{2}(:?\d{2})?)(?:$|\D)", filename)
+    if m:
+        y1 = m.group(1)
+        y2 = m.group(2)
+        if str(int(y1) + 1).endswith(y2):
+            return y1
+    return None
+
+"""
+Infer which special column (if any) a header field is
+"""
+def inferColumn(name):
+    for pattern in inferColumns:
+        if re.match(pattern["pattern"], name, re.IGNORECASE):
+            return pattern["value"]
+    return None
+
+"""
+Default contest name, e.g. "Keemia lõppvoor 2019/2020"
+"""
+def contestName(subject, type, year):
+    return f"{subject} {type.lower()} {year}/{int(year) + 1}"
+
+"""
+Default subcontest name, e.g. "9. klassi õpilaste tulemused"
+"""
+def subcontestName(classRangeName, minClass, maxClass):
+    if minClass == maxClass:
+        return f"{minClass}. klassi õpilaste tulemused"
+    return f"{ageGroupNames.get(classRangeName, classRangeName.capitalize())} õpilaste tulemused"
@@ -1,12 +1,24 @@
 import tkinter as tk
 import tkinter.ttk as ttk
+import tkinter.font as tkfont
 from tkinter.filedialog import askopenfilename
 from tkinter import messagebox as tkmsg
 import re
 import csv
 import copy
+import bisect
+import heapq
 import logging
+import threading
+import queue
 import importoly
+import infer
+
+# The GUI imports in bulk (see importoly.addContestantsBulk), which is much
+# faster than adding the contestants one at a time. Progress is reported (and
+# cancel checked) per chunk, and cancel also between the statements of a
+# chunk, so the chunks are kept small enough for both to follow along.
+importoly.bulk_chunk_size = 100
 
 contestFields = [
     {"name": "name", "display": "Contest name"},
@@ -31,46 +43,6 @@ specialColumns = [
     {"name": "total", "color": "#ffcc00"}
 ]
 
-inferContest = {
-    "subject": [
-        {"pattern": "efo|fyysika|füüsika|fys", "value": "Füüsika"},
-        {"pattern": "emo|mat|lvs|lvt", "value": "Matemaatika"},
-        {"pattern": "eko|keemia", "value": "Keemia"},
-        {"pattern": "inf", "value": "Informaatika"},
-        {"pattern": "ego", "value": "Geograafia"},
-        {"pattern": "ebo", "value": "Bioloogia"},
-    ],
-    "type": [
-        {"pattern": "lv[0-9st]", "value": "Lahtine"},
-        {"pattern": "lv", "value": "Lõppvoor"},
-        {"pattern": "lah", "value": "Lahtine"},
-    ],
-    "class_range": [
-        {"pattern": "(^|[^1-9])6k", "value": "6,6,6"},
-        {"pattern": "(^|[^1-9])7k", "value": "7,7,7"},
-        {"pattern": "(^|[^1-9])8k", "value": "8,8,8"},
-        {"pattern": "(^|[^1-9])9k", "value": "9,9,9"},
-        {"pattern": "10k", "value": "10,10,10"},
-        {"pattern": "11k", "value": "11,11,11"},
-        {"pattern": "12k", "value": "12,12,12"},
-        {"pattern": "(^|[-_ ])g($|[-_.])", "value": "gümnaasium,10,12"},
-        {"pattern": "(^|[-_ ])pk?($|[-_.])", "value": "põhikool,8,9"},
-        {"pattern": "(^|[-_ ])v($|[-_.])", "value": "vanem,11,12"},
-        {"pattern": "(^|[-_ ])n($|[-_.])", "value": "noorem,9,10"},
-    ]
-}
-
-inferColumns = [
-    {"pattern": r"(jrk|koht)\.?", "value": "placement"},
-    {"pattern": r".*eesnimi", "value": "first name"},
-    {"pattern": r".*pere(konna)?nimi", "value": "last name"},
-    {"pattern": r"(õpilane|(õpilase )?nimi)\.?", "value": "name"},
-    {"pattern": r"kool\.?", "value": "school"},
-    {"pattern": r"kl(ass)?\.?", "value": "class"},
-    {"pattern": r".*(juhendajad?|õp(etaja)?).*", "value": "instructors"},
-    {"pattern": r".*kokku.*", "value": "total"},
-]
-
 deleteColumnColor = "#ffaaaa"
 
 
@@ -79,83 +51,145 @@ def warn(text):
     tkmsg.showwarning(message=text)
 
 
-class ScrollableFrame(tk.Frame):
-    def __init__(self, root, *args, **kwargs):
-        self.root = root
-        self.canvas = tk.Canvas(self.root)
-        super().__init__(self.canvas, *args, **kwargs)
-        self.canvas.create_window(0, 0, window=self, anchor=tk.NW)
-
-        def onScroll(event):
-            self.canvas.yview_scroll(-1 if event.num == 4 else 1, "units")
-
-        self.canvas.bind_all("<Button-4>", onScroll)
-        self.canvas.bind_all("<Button-5>", onScroll)
-
-        self.bind("<Configure>", lambda *_: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
-
-    def pack(self, *args, **kwargs):
-        self.canvas.pack(*args, **kwargs)
-
-    def setYScrollbar(self, scrollbar):
-        scrollbar.configure(command=self.canvas.yview)
-        self.canvas.configure(yscrollcommand=scrollbar.set)
-
 def setEntry(entry, value):
     entry.delete(0, tk.END)
     entry.insert(0, value)
 
+# The grid is kept as a list of rows (the first one being the header of the
+# CSV) and only the visible cells are drawn on a canvas, so big tables don't
+# need a widget per cell
+gridData = []
+columnWidths = []
+# x coordinates of the column edges, computed from columnWidths
+columnX = [0]
 selectedField = None
+redrawJob = None
+
+cellPadding = 4
+maxColumnWidth = 300
+gridLineColor = "#a0a0a0"
+
+def cellText(value):
+    return value.replace("\n", " \u21b5 ")
+
+"""
+Width of a column with the given values
+Only the longest values are measured, as measuring every cell of a big table
+is slow
+"""
+def columnWidth(values):
+    longest = heapq.nlargest(3, (cellText(v) for v in values), key=len)
+    w = max(gridFont.measure(v) for v in longest + ["Delete"])
+    return min(w, maxColumnWidth) + 2 * cellPadding
+
+def updateLayout():
+    columnX[:] = [0]
+    for w in columnWidths:
+        columnX.append(columnX[-1] + w)
+    gridCanvas.configure(scrollregion=(0, 0, columnX[-1], headerHeight + len(gridData) * rowHeight))
+    redrawGrid()
+
+def redrawGrid(*_):
+    global redrawJob
+    if redrawJob is None:
+        redrawJob = root.after_idle(drawGrid)
+
+"""
+Draw the visible cells, with the row of delete buttons always at the top
+"""
+def drawGrid():
+    global redrawJob
+    redrawJob = None
+    gridCanvas.delete("all")
+
+    left = gridCanvas.canvasx(0)
+    top = gridCanvas.canvasy(0)
+    right = left + gridCanvas.winfo_width()
+    bottom = top + gridCanvas.winfo_height()
+    firstRow = max(0, int(top // rowHeight))
+    lastRow = min(len(gridData), int((bottom - headerHeight) // rowHeight) + 1)
+    firstColumn = max(0, bisect.bisect_right(columnX, left) - 1)
+    lastColumn = min(len(columnWidths), bisect.bisect_left(columnX, right))
+
+    colors = {sc["coli"]: sc["color"] for sc in specialColumns if sc["coli"] is not None}
+    # column by column, so that the cells of the next column cover any text
+    # that doesn't fit
+    for ci in range(firstColumn, lastColumn):
+        x1, x2 = columnX[ci], columnX[ci + 1]
+        color = colors.get(ci, defaultColor)
+        for ri in range(firstRow, lastRow):
+            y = headerHeight + ri * rowHeight
+            gridCanvas.create_rectangle(x1, y, x2, y + rowHeight, fill=color, outline=gridLineColor)
+            gridCanvas.create_text(x1 + cellPadding, y + rowHeight / 2, text=cellText(gridData[ri][ci]), anchor=tk.W,
+                                   font=boldFont if selectedField == (ri, ci) else gridFont)
+        gridCanvas.create_rectangle(x1, top, x2, top + headerHeight, fill=deleteColumnColor, outline=gridLineColor)
+        gridCanvas.create_text(x1 + cellPadding, top + headerHeight / 2, text="Delete", anchor=tk.W, font=gridFont)
+
+def gridClick(event):
+    ci = bisect.bisect_right(columnX, gridCanvas.canvasx(event.x)) - 1
+    if ci < 0 or ci >= len(columnWidths):
+        return
+    if event.y < headerHeight:
+        deleteColumn(ci)
+        return
+    ri = int((gridCanvas.canvasy(event.y) - headerHeight) // rowHeight)
+    if 0 <= ri < len(gridData):
+        selectField(ri, ci)
 
 def selectField(ri, ci):
     global selectedField
-    if selectedField is not None:
-        currentGrid[selectedField[0]][selectedField[1]].configure(font="sans 11")
-    currentGrid[ri][ci].configure(font="sans 11 bold")
     selectedField = (ri, ci)
-    setEntry(editField, currentGrid[ri][ci]["text"])
-
-def fieldButton(ri, ci):
-    def action(*_):
-        selectField(ri, ci)
-    return action
+    setEntry(editField, gridData[ri][ci])
+    redrawGrid()
 
 def clearGrid(clearSpecial=True):
     global selectedField
 
-    for row in currentGrid:
-        for field in row:
-            field.destroy()
-    currentGrid.clear()
-    for field in gridHeader:
-        field.destroy()
-    gridHeader.clear()
+    gridData.clear()
+    columnWidths.clear()
     selectedField = None
 
     if clearSpecial:
         for sc in specialColumns:
             sc["coli"] = None
+    updateLayout()
 
-def deleteColumnAction(ci):
-    def action(*_):
-        # Delete the column
-        grid = getGrid()
-        for row in grid:
-            del row[ci]
+def deleteColumn(ci):
+    global selectedField
 
-        setGrid(grid, False)
+    for row in gridData:
+        del row[ci]
+    del columnWidths[ci]
+    selectedField = None
 
-        # Update the special columns
-        for sc in specialColumns:
-            if sc["coli"] is None:
-                pass
-            elif sc["coli"] == ci:
-                sc["coli"] = None
-            elif sc["coli"] > ci:
-                sc["coli"] -= 1
-        highlightGrid()
+    # Update the special columns
+    for sc in specialColumns:
+        if sc["coli"] is None:
+            pass
+        elif sc["coli"] == ci:
+            sc["coli"] = None
+        elif sc["coli"] > ci:
+            sc["coli"] -= 1
+    updateLayout()
 
-    return action
+"""
+Insert a column with the given header, filled with `fill`
+"""
+def insertColumn(ci, header, fill):
+    global selectedField
+
+    rows = iter(gridData)
+    next(rows).insert(ci, header)
+    for row in rows:
+        row.insert(ci, fill)
+    columnWidths.insert(ci, columnWidth([header, fill]))
+    selectedField = None
+
+    # Update the special columns
+    for sc in specialColumns:
+        if sc["coli"] is not None and sc["coli"] >= ci:
+            sc["coli"] += 1
+    updateLayout()
 
 """
 Set the grid to a 2D list of values
@@ -166,30 +200,16 @@ def setGrid(grid, clearSpecial=True):
     if len(grid) == 0:
         return
 
-    for ri, row in enumerate(grid):
-        newRow = []
-        currentGrid.append(newRow)
-        for ci, field in enumerate(row):
-            e = tk.Button(gridWrapper, text=field, command=fieldButton(ri, ci))
-            e.grid(row=ri+1, column=ci, sticky="nsew")
-            newRow.append(e)
-
+    gridData.extend(grid)
     for ci in range(len(grid[0])):
-        h = tk.Button(gridWrapper, text="Delete", command=deleteColumnAction(ci), background=deleteColumnColor)
-        h.grid(row=0, column=ci)
-        gridHeader.append(h)
+        columnWidths.append(columnWidth(row[ci] for row in grid))
+    updateLayout()
 
 """
 Get the grid as a 2D list of values
 """
 def getGrid():
-    grid = []
-    for row in currentGrid:
-        grid.append([])
-        for v in row:
-            grid[-1].append(v["text"])
-
-    return grid
+    return [list(row) for row in gridData]
 
 """
 Parse a CSV file into the editor
@@ -230,32 +250,23 @@ Infer the content of some fields based on the filename and column names
 """
 def inferFields(filename):
     # Contest info
-
-    for fieldName, patterns in inferContest.items():
+    for fieldName, value in infer.inferContestFields(filename).items():
         field = findName(contestFields, fieldName)
         if not field["lock"].get():
-            for pattern in patterns:
-                if re.search(pattern["pattern"], filename, re.IGNORECASE):
-                    setEntry(field["entry"], pattern["value"])
-                    break
+            setEntry(field["entry"], value)
 
     # Special case for the year
     year = findName(contestFields, "year")
     if not year["lock"].get():
-        m = re.search(r"(?:^|\D)(\d{4})\D(\d{2}(:?\d{2})?)(?:$|\D)", filename)
-        if m:
-            y1 = m.group(1)
-            y2 = m.group(2)
-            if str(int(y1) + 1).endswith(y2):
-                y2 = str(int(y1) + 1)
-                setEntry(year["entry"], f"{y1}")
+        y1 = infer.inferYear(filename)
+        if y1 is not None:
+            setEntry(year["entry"], y1)
 
     # Columns
-    for ci, name in enumerate(currentGrid[0]):
-        for pattern in inferColumns:
-            if re.match(pattern["pattern"], name["text"], re.IGNORECASE):
-                findName(specialColumns, pattern["value"])["coli"] = ci
-                break
+    for ci, name in enumerate(gridData[0]):
+        value = infer.inferColumn(name)
+        if value is not None:
+            findName(specialColumns, value)["coli"] = ci
     highlightGrid()
 
 lastOpenedFile = None
@@ -282,15 +293,8 @@ def reopenFile():
     highlightGrid()
 
 def highlightGrid():
-    # clear any highlighting
-    for row in currentGrid:
-        for field in row:
-            field.configure(background=defaultColor)
-
-    for sc in specialColumns:
-        if sc["coli"] is not None:
-            for row in currentGrid:
-                row[sc["coli"]].configure(background=sc["color"])
+    # the colors are decided when drawing
+    redrawGrid()
 
 def importTable(*_):
     if any(field["entry"].get() == "" for field in contestFields if field["name"] != "description"):
@@ -365,7 +369,70 @@ def importTable(*_):
 
         subcontest["contestants"].append(contestant)
 
-    importoly.addContest(contest)
+    startImport(contest)
+
+# messages from the import thread: ("progress", count), ("done", None),
+# ("cancelled", None) or ("error", message)
+importQueue = queue.Queue()
+importCancel = threading.Event()
+
+"""
+Run the import (in bulk, see above), on a separate thread so that the window
+stays responsive
+Only reports back through importQueue, as Tk must not be used from here.
+"""
+def runImport(contest):
+    try:
+        importoly.addContest(contest, bulk=True, progress=lambda n: importQueue.put(("progress", n)), cancel=importCancel)
+        importQueue.put(("done", None))
+    except importoly.Cancelled:
+        importQueue.put(("cancelled", None))
+    except Exception as e:
+        # addContest has already logged the actual exception
+        importQueue.put(("error", str(e.__context__ or e)))
+
+def startImport(contest):
+    total = sum(len(sc["contestants"]) for sc in contest["subcontests"])
+    importCancel.clear()
+    importButton.configure(state=tk.DISABLED)
+    cancelButton.configure(state=tk.NORMAL)
+    importProgress.configure(maximum=max(total, 1), value=0)
+    importStatus.configure(text=f"Importing 0/{total}")
+    threading.Thread(target=runImport, args=(contest,), daemon=True).start()
+    root.after(100, pollImport, total)
+
+def pollImport(total):
+    while True:
+        try:
+            kind, value = importQueue.get_nowait()
+        except queue.Empty:
+            break
+        if kind == "progress":
+            importProgress.configure(value=value)
+            if not importCancel.is_set():
+                importStatus.configure(text=f"Importing {value}/{total}")
+        else:
+            finishImport(kind, value, total)
+            return
+    root.after(100, pollImport, total)
+
+def finishImport(kind, value, total):
+    importButton.configure(state=tk.NORMAL)
+    cancelButton.configure(state=tk.DISABLED)
+    if kind == "done":
+        importProgress.configure(value=total)
+        importStatus.configure(text=f"Imported {total} contestants")
+    elif kind == "cancelled":
+        importProgress.configure(value=0)
+        importStatus.configure(text="Cancelled, nothing was imported")
+    else:
+        importProgress.configure(value=0)
+        importStatus.configure(text="Import failed")
+        warn(f"Import failed: {value}")
+
+def cancelImport(*_):
+    importCancel.set()
+    importStatus.configure(text="Cancelling...")
 
 # interface
 root = tk.Tk()
@@ -380,6 +447,12 @@ reloadButton = tk.Button(toolbar, text="Reload", command=reopenFile)
 reloadButton.pack(side='left')
 importButton = tk.Button(toolbar, text="Import", command=importTable)
 importButton.pack(side='left')
+cancelButton = tk.Button(toolbar, text="Cancel", command=cancelImport, state=tk.DISABLED)
+cancelButton.pack(side='left')
+importProgress = ttk.Progressbar(toolbar, length=200)
+importProgress.pack(side='left')
+importStatus = tk.Label(toolbar)
+importStatus.pack(side='left')
 
 # contest info
 contestInfo = tk.Frame(root)
@@ -404,7 +477,10 @@ editField.grid(row=0, column=0)
 
 def applyEdit(*_):
     if selectedField is not None:
-        currentGrid[selectedField[0]][selectedField[1]].configure(text=editField.get())
+        ri, ci = selectedField
+        gridData[ri][ci] = editField.get()
+        columnWidths[ci] = max(columnWidths[ci], columnWidth([gridData[ri][ci]]))
+        updateLayout()
 
 editField.bind("<Return>", applyEdit)
 
@@ -438,19 +514,7 @@ def genPlacementAction(*_):
         placement = specialColumnsN["placement"]["coli"]
         if placement is None:
             # Create the placement column
-            grid = getGrid()
-            rows = iter(grid)
-            header = next(rows)
-            header.insert(0, "Koht")
-            for row in rows:
-                row.insert(0, "0")
-
-            setGrid(grid, False)
-
-            # Increment the indices
-            for sc in specialColumns:
-                if sc["coli"] is not None:
-                    sc["coli"] += 1
+            insertColumn(0, "Koht", "0")
 
             specialColumnsN["placement"]["coli"] = 0
             placement = 0
@@ -462,18 +526,19 @@ def genPlacementAction(*_):
         currPlace = 0
         startPlace = 0
 
-        rows = iter(currentGrid)
+        rows = iter(gridData)
         # Skip the header
         next(rows)
         for row in rows:
-            s = float(row[total]["text"].replace(",", ".").replace('%',''))
+            s = float(row[total].replace(",", ".").replace('%',''))
             currPlace += 1
             if s < lastS:
-                row[placement].configure(text=str(currPlace))
+                row[placement] = str(currPlace)
                 lastS = s
                 startPlace = currPlace
             else:
-                row[placement].configure(text=str(startPlace))
+                row[placement] = str(startPlace)
+        redrawGrid()
 genPlacementButton = tk.Button(editor, text='From "total"', command=genPlacementAction, background=specialColumnsN["placement"]["color"])
 genPlacementButton.grid(row=2, column=specialColumnsN["placement"]["ci"])
 
@@ -482,15 +547,33 @@ nameOrderRevCheck = tk.Checkbutton(editor, text="Reversed name", variable=nameOr
 nameOrderRevCheck.grid(row=2, column=specialColumnsN["name"]["ci"])
 
 # grid
-gridWrapper = ScrollableFrame(root)
-gridWrapper.pack(fill=tk.BOTH, expand=1, after=editor, side=tk.LEFT)
+gridFont = tkfont.Font(family="sans", size=11)
+boldFont = tkfont.Font(family="sans", size=11, weight="bold")
+rowHeight = gridFont.metrics("linespace") + 2 * cellPadding
+headerHeight = rowHeight
 
+gridScrollX = tk.Scrollbar(root, orient=tk.HORIZONTAL)
+gridScrollX.pack(fill=tk.X, side=tk.BOTTOM)
 gridScrollY = tk.Scrollbar(root, orient=tk.VERTICAL)
 gridScrollY.pack(fill=tk.Y, side=tk.RIGHT)
-gridWrapper.setYScrollbar(gridScrollY)
 
-currentGrid = []
-gridHeader = []
+gridCanvas = tk.Canvas(root, background=defaultColor, highlightthickness=0, yscrollincrement=rowHeight)
+gridCanvas.pack(fill=tk.BOTH, expand=1, after=editor, side=tk.LEFT)
+
+def onScroll(scrollbar):
+    def action(*args):
+        scrollbar.set(*args)
+        redrawGrid()
+    return action
+
+gridCanvas.configure(xscrollcommand=onScroll(gridScrollX), yscrollcommand=onScroll(gridScrollY))
+gridScrollX.configure(command=gridCanvas.xview)
+gridScrollY.configure(command=gridCanvas.yview)
+gridCanvas.bind("<Configure>", redrawGrid)
+gridCanvas.bind("<Button-1>", gridClick)
+gridCanvas.bind_all("<Button-4>", lambda *_: gridCanvas.yview_scroll(-1, "units"))
+gridCanvas.bind_all("<Button-5>", lambda *_: gridCanvas.yview_scroll(1, "units"))
+gridCanvas.bind_all("<MouseWheel>", lambda event: gridCanvas.yview_scroll(-1 if event.delta > 0 else 1, "units"))
 
 openFile()
 tk.mainloop()
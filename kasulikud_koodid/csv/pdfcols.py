@@ -0,0 +1,296 @@
+"""
+Extracting table columns from the text of PDF pages, shared by the
+interactive `extractcols.py` and its headless modes.
+
+Everything works in the coordinates of the page image shown in the window
+(origin at the top left, in pixels), so that the tolerances are the same
+with and without the GUI. Templates store their boxes in PDF coordinates,
+so they don't depend on the resolution the page happened to be shown at.
+"""
+
+import csv
+import json
+import os
+from collections import defaultdict
+from typing import Iterable
+
+import numpy as np
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextLineHorizontal, LTChar
+
+# size of the page window
+MAX_WIDTH = 1800
+MAX_HEIGHT = 1000
+
+TEMPLATES_FILE = os.path.join(os.path.dirname(__file__), "extractcols_templates.json")
+
+def get_texts(root):
+    if isinstance(root, LTTextLineHorizontal):
+        yield root
+        return
+    if isinstance(root, Iterable):
+        for el in root:
+            yield from get_texts(el)
+
+def reorder(r):
+    p1 = min(r[0][0], r[1][0]), min(r[0][1], r[1][1])
+    p2 = max(r[0][0], r[1][0]), max(r[0][1], r[1][1])
+    return (p1, p2)
+
+def overlap_lin(a, b):
+    return max(0, min(a[1], b[1]) - max(a[0], b[0]) + 1)
+
+def overlap(r1, r2):
+    r1 = reorder(r1)
+    r2 = reorder(r2)
+    x = overlap_lin((r1[0][0], r1[1][0]), (r2[0][0], r2[1][0]))
+    y = overlap_lin((r1[0][1], r1[1][1]), (r2[0][1], r2[1][1]))
+    return x, y
+
+def dims(r):
+    r = reorder(r)
+    return (r[1][0] - r[0][0] + 1, r[1][1] - r[0][1] + 1)
+
+"""
+Scale at which a page of the given size fits into the window
+"""
+def displayScale(layout):
+    return min(MAX_WIDTH / layout.bbox[2], MAX_HEIGHT / layout.bbox[3])
+
+class GridIndex:
+    """
+    Boxes bucketed into a grid of square cells, to find the boxes that might
+    overlap a rectangle without testing every box on the page
+    """
+    def __init__(self, boxes, cell=32):
+        self.cell = cell
+        self.buckets = defaultdict(list)
+        for i, box in enumerate(boxes):
+            for key in self.cells(box):
+                self.buckets[key].append(i)
+
+    def cells(self, box):
+        (x1, y1), (x2, y2) = reorder(box)
+        for cx in range(x1 // self.cell, x2 // self.cell + 1):
+            for cy in range(y1 // self.cell, y2 // self.cell + 1):
+                yield cx, cy
+
+    def query(self, box):
+        """Indexes of the boxes in the cells touched by `box` (a superset of the overlapping ones)"""
+        found = set()
+        for key in self.cells(box):
+            found.update(self.buckets.get(key, ()))
+        return found
+
+class Page:
+    """
+    The text lines of a pdfminer page, in the coordinates of an iw x ih image
+    of it
+    """
+    def __init__(self, layout, iw, ih):
+        self.layout = layout
+        self.iw = iw
+        self.ih = ih
+        self.scx = iw / layout.bbox[2]
+        self.scy = ih / layout.bbox[3]
+
+        # (characters with their boxes, box) for each text line
+        self.boxes = []
+        for tb in get_texts(layout):
+            box = self.box_to_image(tb.bbox)
+            self.boxes.append(([(ch, self.box_to_image(ch.bbox)) for ch in tb if isinstance(ch, LTChar)], box))
+
+        self.boxes.sort(key=lambda x: x[1][0][1])
+        self.index = GridIndex([box for _, box in self.boxes])
+
+        # the same as arrays: bottom edges of the lines, and the text, line
+        # and (x1, y1, x2, y2) box of every character, line by line
+        self.lineBottoms = np.array([reorder(box)[1][1] for _, box in self.boxes], dtype=int)
+        chars = [(li, ch.get_text(), reorder(cbox)) for li, (chars, _) in enumerate(self.boxes) for ch, cbox in chars]
+        self.charTexts = [text for _, text, _ in chars]
+        self.charLines = np.array([li for li, _, _ in chars], dtype=int)
+        self.charBoxes = np.array([(b[0][0], b[0][1], b[1][0], b[1][1]) for _, _, b in chars], dtype=int).reshape(-1, 4)
+
+    def box_to_image(self, box):
+        x1, y1, x2, y2 = map(round, (box[0] * self.scx, self.ih - box[1] * self.scy, box[2] * self.scx, self.ih - box[3] * self.scy))
+        return (x1, y1), (x2, y2)
+
+    def box_to_pdf(self, box):
+        (x1, y1), (x2, y2) = box
+        return [x1 / self.scx, (self.ih - y1) / self.scy, x2 / self.scx, (self.ih - y2) / self.scy]
+
+    def overlapping(self, box):
+        """Indexes of the text lines overlapping `box`, from top to bottom"""
+        return sorted(i for i in self.index.query(box) if min(overlap(box, self.boxes[i][1])) > 0)
+
+"""
+Propose column boxes for the table on a page
+Text lines are grouped into rows by their bottom edges, and the x ranges that
+(almost) no row has characters in are taken as the gaps between columns. Only
+rows with more than one text line are used, so that titles and other text
+around the table don't fill the gaps.
+Returns (column boxes from left to right, bottom edges of the rows)
+"""
+def detectColumns(page, tolerance=4, maxCrossing=0.05):
+    lines = [(chars, reorder(box)) for chars, box in page.boxes if chars]
+    if not lines:
+        return [], []
+    tops = np.array([box[0][1] for _, box in lines])
+    bottoms = np.array([box[1][1] for _, box in lines])
+
+    # rows: runs of bottom edges at most `tolerance` apart
+    order = np.argsort(bottoms, kind="stable")
+    rowOf = np.empty(len(lines), dtype=int)
+    rowOf[order] = np.concatenate(([0], np.cumsum(np.diff(bottoms[order]) > tolerance)))
+    inTable = np.bincount(rowOf)[rowOf] > 1
+    if not inTable.any():
+        inTable[:] = True
+
+    # x ranges of the (non-blank) characters in the table, with their rows
+    x1s, x2s, charRows = [], [], []
+    for li in np.flatnonzero(inTable):
+        for ch, cbox in lines[li][0]:
+            if ch.get_text().strip():
+                (x1, _), (x2, _) = reorder(cbox)
+                x1s.append(x1)
+                x2s.append(x2)
+                charRows.append(rowOf[li])
+    if not x1s:
+        return [], []
+    x1s = np.clip(np.array(x1s), 0, page.iw)
+    x2s = np.clip(np.array(x2s), 0, page.iw)
+    rows, charRows = np.unique(charRows, return_inverse=True)
+
+    # how many rows have characters at each x
+    cover = np.zeros((len(rows), page.iw + 2), dtype=int)
+    np.add.at(cover, (charRows, x1s), 1)
+    np.add.at(cover, (charRows, x2s + 1), -1)
+    support = (np.cumsum(cover, axis=1) > 0).sum(axis=0)
+    filled = np.concatenate(([0], support > maxCrossing * len(rows), [0])).astype(int)
+    edges = np.diff(filled)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    if len(starts) == 0:
+        return [], []
+
+    # gaps narrower than a character are spaces between words, not columns
+    minGap = max(2, np.median(x2s - x1s))
+    keep = np.concatenate(([True], starts[1:] - ends[:-1] - 1 >= minGap))
+    starts = starts[keep]
+    ends = ends[np.concatenate((keep[1:], [True]))]
+
+    top = tops[inTable].min() - 1
+    bottom = bottoms[inTable].max() + 1
+    columns = [((int(x1) - 1, int(top)), (int(x2) + 1, int(bottom))) for x1, x2 in zip(starts, ends)]
+
+    rowBottoms = np.zeros(rowOf.max() + 1, dtype=int)
+    np.maximum.at(rowBottoms, rowOf[inTable], bottoms[inTable])
+    return columns, [int(y) for y in rowBottoms[np.unique(rowOf[inTable])]]
+
+"""
+Get the table in the column boxes of a page, as a list of rows
+Text lines touching any of the remove boxes are left out. The text of a
+column box on one text line is a piece; each piece of the first column box
+(the first one with any text) starts a row. The pieces of the other columns
+go to the last row that starts at most `tolerance` pixels below them, so a
+piece further down than that is the next line of a multi-line cell and is
+joined to it with a newline.
+"""
+def extractTable(page, selectBoxes, removeBoxes, tolerance=4):
+    if not selectBoxes or len(page.charTexts) == 0:
+        return []
+    removed = np.zeros(len(page.boxes), dtype=bool)
+    for rb in removeBoxes:
+        removed[page.overlapping(rb)] = True
+
+    # which characters are completely inside which column box
+    cols = np.array([(*reorder(box)[0], *reorder(box)[1]) for box in selectBoxes])
+    cb = page.charBoxes[:, None, :]
+    inside = ((cb[..., 0] >= cols[:, 0]) & (cb[..., 1] >= cols[:, 1]) &
+              (cb[..., 2] <= cols[:, 2]) & (cb[..., 3] <= cols[:, 3]) &
+              ~removed[page.charLines][:, None])
+    charIdx, colIdx = np.nonzero(inside)
+    # by column, then line by line as the characters are
+    order = np.lexsort((charIdx, colIdx))
+    charIdx = charIdx[order]
+    colIdx = colIdx[order]
+    lineIdx = page.charLines[charIdx]
+
+    starts = np.flatnonzero(np.concatenate(([True], (colIdx[1:] != colIdx[:-1]) | (lineIdx[1:] != lineIdx[:-1]))))
+    ends = np.append(starts[1:], len(charIdx))
+    texts = ["".join(page.charTexts[i] for i in charIdx[s:e]).strip() for s, e in zip(starts, ends)]
+    keep = np.array([len(t) > 0 for t in texts], dtype=bool)
+    if not keep.any():
+        return []
+    texts = [t for t, k in zip(texts, keep) if k]
+    pieceCols = colIdx[starts][keep]
+    pieceLines = lineIdx[starts][keep]
+    pieceYs = page.lineBottoms[pieceLines]
+
+    first = pieceCols == pieceCols[0]
+    rowYs = pieceYs[first]
+    rows = np.maximum(np.searchsorted(rowYs, pieceYs + tolerance, side="right") - 1, 0)
+    rows[first] = np.arange(len(rowYs))
+
+    table = [["" for _ in selectBoxes] for _ in rowYs]
+    for i in np.lexsort((pieceLines, pieceCols, rows)):
+        r, c = rows[i], pieceCols[i]
+        table[r][c] = texts[i] if not table[r][c] else table[r][c] + '\n' + texts[i]
+    return table
+
+def writeCsv(filename, rows):
+    width = max((len(row) for row in rows), default=0)
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        for row in rows:
+            writer.writerow(row + ["" for _ in range(width - len(row))])
+
+def loadTemplates():
+    try:
+        with open(TEMPLATES_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+"""
+Save the boxes drawn on a page as a named template
+"""
+def saveTemplate(name, page, selectBoxes, removeBoxes):
+    templates = loadTemplates()
+    templates[name] = {
+        "select": [page.box_to_pdf(box) for box in selectBoxes],
+        "remove": [page.box_to_pdf(box) for box in removeBoxes],
+    }
+    with open(TEMPLATES_FILE, "w") as f:
+        json.dump(templates, f, indent=2)
+
+"""
+Get the boxes of a template in the coordinates of a page
+Returns (selectBoxes, removeBoxes)
+"""
+def templateBoxes(template, page):
+    return ([page.box_to_image(box) for box in template["select"]],
+            [page.box_to_image(box) for box in template["remove"]])
+
+"""
+Convert a PDF to CSV with the boxes of a template, without showing anything
+Without a template, the columns are detected on every page.
+Runs in a worker process.
+Returns (pdf, number of rows, error)
+"""
+def convertFile(pdf, csvFile, template):
+    try:
+        rows = []
+        for layout in extract_pages(pdf):
+            f = displayScale(layout)
+            page = Page(layout, round(layout.bbox[2] * f), round(layout.bbox[3] * f))
+            if template is None:
+                selectBoxes, removeBoxes = detectColumns(page)[0], []
+            else:
+                selectBoxes, removeBoxes = templateBoxes(template, page)
+            rows += extractTable(page, selectBoxes, removeBoxes)
+        writeCsv(csvFile, rows)
+        return pdf, len(rows), None
+    except Exception as e:
+        return pdf, 0, str(e)
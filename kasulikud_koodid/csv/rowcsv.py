@@ -39,48 +39,80 @@ def specialKey(s):
     u = re.sub("[.-/?]", "", s.upper())
     return specialMap.get(u, None)
 
-def parseCsv(filename):
-    contestants = []
+"""
+Read the header row, returning the raw column names and the special key (or
+None) of each of them
+"""
+def parseHeader(reader):
+    # note: removing zero-width characters sometimes present in files
+    rawColumns = list(re.sub('[\ufeff]', '', c).strip() for c in next(reader))
+
+    # first simple check (the first column is *usually* the placement
+    if rawColumns[0].isdigit():
+        raise Exception('No header row')
+
+    keys = [specialKey(c) for c in rawColumns]
+    columns = [c for c, k in zip(rawColumns, keys) if k is None]
+    spColumns = [k for k in keys if k is not None]
+
+    logging.info(f'Columns: {columns}')
+    logging.info(f'Special columns: {spColumns}')
+
+    # second check: are all required columns present?
+    for r in required:
+        if r not in spColumns:
+            raise Exception(f'Column "{r}" not found in data')
+
+    return columns, keys
+
+"""
+Streaming version of parseCsv: the header is read right away, but the
+contestants are returned as a generator reading the file row by row.
+
+Rows that fail validation are skipped instead of raising an exception. If a
+list is passed as `errors`, (line number, message) tuples are appended to it
+for each of them.
+
+The generator opens the file again when it is first read and closes it when
+it is done (or closed, or garbage collected), so one that is never read
+doesn't keep the file open.
+"""
+def streamCsv(filename, errors = None):
     with open(filename, newline='') as f:
-        reader = csv.reader(f, delimiter=',')
-        # note: removing zero-width characters sometimes present in files
-        rawColumns = list(re.sub('[\ufeff]', '', c).strip() for c in next(reader))
-
-        # first simple check (the first column is *usually* the placement
-        if rawColumns[0].isdigit():
-            raise Exception('No header row')
-        
-        columns = [c for c in rawColumns if specialKey(c) is None]
-        spColumns = [c for c in map(specialKey, rawColumns) if c is not None]
-
-        logging.info(f'Columns: {columns}')
-        logging.info(f'Special columns: {spColumns}')
-
-        # second check: are all required columns present?
-        for r in required:
-            if r not in spColumns:
-                raise Exception(f'Column "{r}" not found in data')
-        
-        for row in reader:
-            contestant = {'fields': [], 'instructors': []}
-            
-            for c, f in zip(rawColumns, row):
-                s = specialKey(c)
-                if s is None:
-                    contestant['fields'].append(f)
-                elif s == 'instructors':
-                    contestant['instructors'] = [i.strip() for i in re.split('[:/,]', f) if i.strip() not in ('', '-')]
-                else:
-                    contestant[s] = f
-                    
-            logging.info(contestant)
-            # third check: does the number of other columns match?
-            # this catches cases where an unescaped extra "," is in the file
-            if len(contestant['fields']) != len(columns):
-                raise Exception('Non-matching field length')
-            
-            contestants.append(contestant)
-        
-    return columns, contestants
+        columns, keys = parseHeader(csv.reader(f, delimiter=','))
+
+    def contestants():
+        with open(filename, newline='') as f:
+            reader = csv.reader(f, delimiter=',')
+            next(reader)
+            for row in reader:
+                contestant = {'fields': [], 'instructors': []}
+
+                for s, v in zip(keys, row):
+                    if s is None:
+                        contestant['fields'].append(v)
+                    elif s == 'instructors':
+                        contestant['instructors'] = [i.strip() for i in re.split('[:/,]', v) if i.strip() not in ('', '-')]
+                    else:
+                        contestant[s] = v
 
-        
+                logging.debug(contestant)
+                # third check: does the number of other columns match?
+                # this catches cases where an unescaped extra "," is in the file
+                if len(contestant['fields']) != len(columns):
+                    logging.warning(f'{filename}:{reader.line_num}: Non-matching field length')
+                    if errors is not None:
+                        errors.append((reader.line_num, 'Non-matching field length'))
+                    continue
+
+                yield contestant
+
+    return columns, contestants()
+
+def parseCsv(filename):
+    errors = []
+    columns, contestants = streamCsv(filename, errors)
+    contestants = list(contestants)
+    if errors:
+        raise Exception(f'{errors[0][1]} on line {errors[0][0]}')
+    return columns, contestants
@@ -0,0 +1,278 @@
+"""
+Database connections shared by the tools.
+
+The credentials are read from `credentials.json` (next to this file) once,
+and connections are kept in a small pool for reuse. `connection()` returns an
+object that is used like a mysql.connector connection, but only connects when
+the first query is made, so the tools start without waiting for the database.
+`close()` puts the connection back into the pool; the connections still open
+when the program exits are closed then.
+
+Before the first query of a transaction, a connection that has been idle for
+a while is checked and reconnected if the server has dropped it. Within a
+transaction, a lost connection is still an error, as the transaction is lost
+with it.
+
+Every query made through a connection is also recorded in its `stats` (see
+QueryStats), to see where the time goes.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import random
+import atexit
+import logging
+import threading
+import weakref
+
+CREDENTIALS_FILE = os.path.join(os.path.dirname(__file__), "credentials.json")
+
+# idle connections kept open for reuse
+POOL_SIZE = 4
+# seconds a connection can be idle before it is checked
+HEALTH_CHECK_AFTER = 30
+# times kept per statement template for the 95th percentile, so that the
+# statistics of a long session stay small
+TIME_SAMPLES = 1000
+
+_lock = threading.RLock()
+_credentials = None
+# (connection, last used) for each idle connection
+_idle = []
+# Connection objects, to close them at exit
+_connections = weakref.WeakSet()
+
+def credentials():
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            with open(CREDENTIALS_FILE) as f:
+                config = json.loads(f.read())
+            _credentials = {"user": config["user"], "password": config["password"],
+                            "database": config["database"], "host": config["host"]}
+        return _credentials
+
+"""
+Take a connection from the pool, or open a new one
+Returns (connection, time it was last used)
+"""
+def acquire():
+    with _lock:
+        if _idle:
+            return _idle.pop()
+    import mysql.connector
+    start = time.perf_counter()
+    conn = mysql.connector.connect(**credentials())
+    logging.info(f'Connected to the database in {time.perf_counter() - start:.2f}s')
+    return conn, time.monotonic()
+
+"""
+Put a connection (without an open transaction) back into the pool
+"""
+def release(conn, lastUsed):
+    with _lock:
+        if len(_idle) < POOL_SIZE:
+            _idle.append((conn, lastUsed))
+            return
+    conn.close()
+
+"""
+Close all the connections, as the tools don't close theirs themselves
+"""
+@atexit.register
+def closeAll():
+    for connection in list(_connections):
+        try:
+            connection.close()
+        except Exception:
+            logging.exception('Could not close a database connection')
+    with _lock:
+        idle = _idle[:]
+        _idle.clear()
+    for conn, _ in idle:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+"""
+The statement template of a query: lists of placeholders (IN lists, rows of
+multi-row INSERTs, see also importoly.valuesTable) are collapsed, so that the
+same statement with a different number of values counts as one
+"""
+def template(query):
+    query = re.sub(r"SELECT %s AS v( UNION ALL SELECT %s AS v)+", "SELECT %s AS v UNION ALL ...", query)
+    query = re.sub(r"%s(, %s)+", "%s, ...", query)
+    return " ".join(query.split())
+
+class QueryStats:
+    """
+    Number of executions, round-trips, affected rows and time taken by the
+    queries of a connection, by statement template
+
+    The 95th percentile is estimated from a random sample of the times
+    (reservoir sampling), the totals are exact.
+    """
+    def __init__(self):
+        self.templates = {}
+
+    def record(self, query, seconds, rows, roundTrips = 1):
+        t = self.templates.setdefault(template(query), {'count': 0, 'roundTrips': 0, 'rows': 0, 'seconds': 0.0, 'times': []})
+        t['count'] += 1
+        t['roundTrips'] += roundTrips
+        # -1 for SELECTs, whose rows aren't known before they are fetched
+        t['rows'] += max(0, rows)
+        t['seconds'] += seconds
+        if len(t['times']) < TIME_SAMPLES:
+            t['times'].append(seconds)
+        else:
+            i = random.randrange(t['count'])
+            if i < TIME_SAMPLES:
+                t['times'][i] = seconds
+
+    def summary(self):
+        """Statistics of each template, the slowest in total first"""
+        result = []
+        for query, t in self.templates.items():
+            times = sorted(t['times'])
+            result.append({
+                'template': query,
+                'count': t['count'],
+                'round_trips': t['roundTrips'],
+                'rows': t['rows'],
+                'total_ms': t['seconds'] * 1000,
+                'p95_ms': times[math.ceil(0.95 * len(times)) - 1] * 1000,
+            })
+        result.sort(key=lambda s: -s['total_ms'])
+        return result
+
+    def format(self, width = 80):
+        lines = [f"{'count':>6} {'trips':>6} {'rows':>7} {'total ms':>9} {'p95 ms':>7}  template"]
+        for s in self.summary():
+            query = s['template'] if len(s['template']) <= width else s['template'][:width - 3] + '...'
+            lines.append(f"{s['count']:>6} {s['round_trips']:>6} {s['rows']:>7} {s['total_ms']:>9.1f} {s['p95_ms']:>7.1f}  {query}")
+        total = sum(t['seconds'] for t in self.templates.values()) * 1000
+        trips = sum(t['roundTrips'] for t in self.templates.values())
+        lines.append(f"{trips} round-trips, {total:.1f} ms in total")
+        return "\n".join(lines)
+
+    def writeJson(self, filename, **extra):
+        """Append the statistics to a file as JSON lines, one per template, with `extra` added to each"""
+        with open(filename, 'a') as f:
+            for s in self.summary():
+                f.write(json.dumps({**extra, **s}, ensure_ascii=False) + "\n")
+
+    def clear(self):
+        self.templates.clear()
+
+class Connection:
+    """
+    Stands in for a mysql.connector connection, connecting lazily and
+    checking the connection between transactions
+
+    An open connection can be given to use instead of one from the pool (e.g.
+    a connection to another database), it is closed instead of pooled.
+    """
+    def __init__(self, conn = None):
+        self._conn = conn
+        self.pooled = conn is None
+        self.lastUsed = time.monotonic()
+        self.inTransaction = False
+        # changes whenever the underlying connection does, so that the
+        # cursors know to create new ones
+        self.generation = 0
+        self.stats = QueryStats()
+        _connections.add(self)
+
+    def raw(self):
+        """The underlying connection, ready for the next query"""
+        if self._conn is None:
+            if not self.pooled:
+                raise Exception('The connection has been closed')
+            self._conn, self.lastUsed = acquire()
+            self.generation += 1
+        if not self.inTransaction and time.monotonic() - self.lastUsed > HEALTH_CHECK_AFTER:
+            if not self._conn.is_connected():
+                logging.warning('Database connection lost, reconnecting')
+                self._conn.reconnect(attempts=3, delay=1)
+                self.generation += 1
+        self.inTransaction = True
+        self.lastUsed = time.monotonic()
+        return self._conn
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        if self._conn is not None:
+            start = time.perf_counter()
+            self._conn.commit()
+            self.stats.record('COMMIT', time.perf_counter() - start, 0)
+        self.inTransaction = False
+
+    def rollback(self):
+        if self._conn is not None:
+            start = time.perf_counter()
+            self._conn.rollback()
+            self.stats.record('ROLLBACK', time.perf_counter() - start, 0)
+        self.inTransaction = False
+
+    def close(self):
+        """Roll back and return the connection to the pool"""
+        if self._conn is not None:
+            self.rollback()
+            if self.pooled:
+                release(self._conn, self.lastUsed)
+            else:
+                self._conn.close()
+            self._conn = None
+
+class Cursor:
+    """
+    A cursor of a Connection, used like a mysql.connector cursor
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._cur = None
+        self._generation = None
+
+    def _cursor(self):
+        conn = self.connection.raw()
+        if self._cur is None or self._generation != self.connection.generation:
+            self._cur = conn.cursor()
+            self._generation = self.connection.generation
+        return self._cur
+
+    def execute(self, query, params = ()):
+        cur = self._cursor()
+        start = time.perf_counter()
+        result = cur.execute(query, params)
+        self.connection.stats.record(query, time.perf_counter() - start, cur.rowcount)
+        return result
+
+    def executemany(self, query, params):
+        cur = self._cursor()
+        start = time.perf_counter()
+        result = cur.executemany(query, params)
+        # mysql.connector sends an INSERT as a single multi-row statement,
+        # anything else one statement at a time
+        roundTrips = 1 if re.match(r"\s*INSERT", query, re.IGNORECASE) else len(params)
+        self.connection.stats.record(query, time.perf_counter() - start, cur.rowcount, roundTrips)
+        return result
+
+    def __iter__(self):
+        if self._cur is None:
+            raise Exception('Nothing has been executed with this cursor yet')
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        # fetchone, rowcount, lastrowid and so on, of the last query
+        if name.startswith('__') or self.__dict__.get('_cur') is None:
+            raise AttributeError(f'Cursor has no attribute {name!r} before the first query')
+        return getattr(self._cur, name)
+
+def connection():
+    return Connection()
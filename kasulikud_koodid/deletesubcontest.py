@@ -1,64 +1,256 @@
 
 """
-Delete a subcontest by id.
+Delete subcontests by id, or a contest with all of its subcontests.
 
-Checks for that contest in the database, then prompts before deleting. The
-response should be "yes" to proceed.
+Checks for the subcontests in the database, prints how many rows would be
+deleted from each table, then prompts before deleting. The response should be
+"yes" to proceed. With --dry-run, nothing is deleted.
 
-When confirmed, deletes all data related to this subcontest, including mentors,
-extra columns and contestant data.
+When confirmed, deletes all data related to these subcontests, including
+mentors, extra columns and contestant data. Contestants are deleted in chunks
+(each in its own transaction) to keep the locks short on a live database; if
+the deletion is interrupted, running it again finishes the job.
+
+With --gc, people and schools that are not referenced by anything anymore
+afterwards are deleted as well.
+
+Examples:
+    python3 deletesubcontest.py 12 13
+    python3 deletesubcontest.py --contest 5 --gc --dry-run
 """
 
 import sys
-import os
-import json
-import mysql.connector
-
-if len(sys.argv) < 2:
-    print("Missing id")
-    sys.exit(1)
-
-id = sys.argv[1]
-
-# Credentials
-with open(os.path.join(os.path.dirname(__file__),"credentials.json")) as f:
-    config = json.loads(f.read())
-mysql_user = config["user"]
-mysql_passwd = config["password"]
-mysql_db = config["database"]
-mysql_host = config["host"]
-
-conn = mysql.connector.connect(user=mysql_user, password=mysql_passwd, database=mysql_db, host=mysql_host)
-cur = conn.cursor()
-
-cur.execute('SELECT name, contest_id FROM subcontest WHERE id = %s', (id,))
-name, contestId = next(cur)
-
-cur.execute('SELECT name FROM contest WHERE id = %s', (contestId,))
-contestName, = next(cur)
-
-ans = input(f'Delete id {id}, "{contestName} {name}"? ')
-print(ans)
-if ans.upper() != 'YES':
-    print('Cancel')
-    sys.exit(0)
-    
-idt = (id,)
-print('.', end='')
-sys.stdout.flush()
-cur.execute('DELETE FROM contestant_field WHERE contestant_id IN (SELECT id FROM contestant WHERE subcontest_id = %s)', idt)
-print('.', end='')
-sys.stdout.flush()
-cur.execute('DELETE FROM subcontest_column WHERE subcontest_id = %s', idt)
-print('.', end='')
-sys.stdout.flush()
-cur.execute('DELETE FROM mentor WHERE contestant_id IN (SELECT id FROM contestant WHERE subcontest_id = %s)', idt)
-print('.', end='')
-sys.stdout.flush()
-cur.execute('DELETE FROM contestant WHERE subcontest_id = %s', idt)
-print('.')
-cur.execute('DELETE FROM subcontest WHERE id = %s', idt)
-
-conn.commit()
-
-print("Done")
+import argparse
+import db
+import summaries
+
+# number of contestants deleted per transaction
+CHUNK_SIZE = 500
+
+def inList(values):
+    return '(' + ', '.join(['%s'] * len(values)) + ')'
+
+def params(values):
+    return tuple(str(v) for v in values)
+
+def chunks(values, size):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+"""
+Find the subcontests to delete
+Returns a list of (id, name, contest name), the subcontest ids that were not
+found and the contest ids that were not found
+"""
+def findSubcontests(cur, ids, contestIds):
+    found = {}
+    missingContests = []
+    if ids:
+        cur.execute('SELECT sc.id, sc.name, c.name FROM subcontest sc JOIN contest c ON c.id = sc.contest_id WHERE sc.id IN ' + inList(ids), params(ids))
+        for id, name, contestName in cur:
+            found[id] = (id, name, contestName)
+    if contestIds:
+        cur.execute('SELECT sc.id, sc.name, c.name FROM subcontest sc JOIN contest c ON c.id = sc.contest_id WHERE sc.contest_id IN ' + inList(contestIds), params(contestIds))
+        for id, name, contestName in cur:
+            found[id] = (id, name, contestName)
+        cur.execute('SELECT id FROM contest WHERE id IN ' + inList(contestIds), params(contestIds))
+        existing = set(id for id, in cur)
+        missingContests = [id for id in contestIds if id not in existing]
+    missing = [id for id in ids if id not in found]
+    return sorted(found.values()), missing, missingContests
+
+"""
+Ids of the people and schools referenced by the contestants of the subcontests
+(the candidates for garbage collection)
+"""
+def referencedIds(cur, ids):
+    cur.execute('SELECT person_id FROM contestant WHERE subcontest_id IN ' + inList(ids) +
+                ' UNION SELECT m.mentor_id FROM mentor m JOIN contestant c ON c.id = m.contestant_id WHERE c.subcontest_id IN ' + inList(ids),
+                params(ids) * 2)
+    people = set(id for id, in cur if id is not None)
+    schools = summaries.subcontestSchoolIds(cur, ids)
+    return people, schools
+
+ORPHAN_PEOPLE = ('SELECT p.id FROM person p WHERE p.id IN {people}'
+                 ' AND NOT EXISTS (SELECT 1 FROM contestant c WHERE c.person_id = p.id AND c.subcontest_id NOT IN {ids})'
+                 ' AND NOT EXISTS (SELECT 1 FROM mentor m JOIN contestant c ON c.id = m.contestant_id WHERE m.mentor_id = p.id AND c.subcontest_id NOT IN {ids})'
+                 ' AND NOT EXISTS (SELECT 1 FROM person_alias a WHERE a.person_id = p.id)')
+
+ORPHAN_SCHOOLS = ('SELECT s.id FROM school s WHERE s.id IN {schools}'
+                  ' AND NOT EXISTS (SELECT 1 FROM contestant c WHERE c.school_id = s.id AND c.subcontest_id NOT IN {ids})'
+                  ' AND NOT EXISTS (SELECT 1 FROM school_alias a WHERE a.correct = s.id)')
+
+"""
+People and schools that would be left unreferenced after deleting the
+subcontests
+"""
+def orphans(cur, ids, people, schools):
+    orphanPeople = []
+    for chunk in chunks(people, CHUNK_SIZE):
+        cur.execute(ORPHAN_PEOPLE.format(people=inList(chunk), ids=inList(ids)), params(chunk) + params(ids) * 2)
+        orphanPeople += [id for id, in cur]
+    orphanSchools = []
+    for chunk in chunks(schools, CHUNK_SIZE):
+        cur.execute(ORPHAN_SCHOOLS.format(schools=inList(chunk), ids=inList(ids)), params(chunk) + params(ids))
+        orphanSchools += [id for id, in cur]
+    return orphanPeople, orphanSchools
+
+"""
+Number of rows that deleting the subcontests would remove, by table
+"""
+def countRows(cur, ids):
+    queries = [
+        ('contestant_field', 'SELECT COUNT(*) FROM contestant_field f JOIN contestant c ON c.id = f.contestant_id WHERE c.subcontest_id IN '),
+        ('mentor', 'SELECT COUNT(*) FROM mentor m JOIN contestant c ON c.id = m.contestant_id WHERE c.subcontest_id IN '),
+        ('contestant', 'SELECT COUNT(*) FROM contestant WHERE subcontest_id IN '),
+        ('subcontest_column', 'SELECT COUNT(*) FROM subcontest_column WHERE subcontest_id IN '),
+        ('subcontest', 'SELECT COUNT(*) FROM subcontest WHERE id IN '),
+    ]
+    counts = {table: 0 for table, _ in queries}
+    if not ids:
+        return counts
+    for table, query in queries:
+        cur.execute(query + inList(ids), params(ids))
+        counts[table], = cur.fetchone()
+    return counts
+
+def progress(text):
+    print('\r' + text, end='')
+    sys.stdout.flush()
+
+"""
+Delete the subcontests, their contestants in chunks, and then the given
+contests if they are left without subcontests
+Returns the number of rows deleted, by table
+"""
+def deleteSubcontests(conn, cur, ids, chunkSize = CHUNK_SIZE, contestIds = ()):
+    counts = {table: 0 for table in ('contestant_field', 'mentor', 'contestant', 'subcontest_column', 'subcontest', 'contest')}
+
+    for id in ids:
+        lastId = 0
+        while True:
+            cur.execute('SELECT id FROM contestant WHERE subcontest_id = %s AND id > %s ORDER BY id LIMIT %s', (str(id), str(lastId), chunkSize))
+            chunk = [cid for cid, in cur]
+            if not chunk:
+                break
+            r = (str(id), str(lastId), str(chunk[-1]))
+            cur.execute('SELECT DISTINCT school_id FROM contestant WHERE subcontest_id = %s AND id > %s AND id <= %s', r)
+            schoolIds = [sid for sid, in cur]
+            cur.execute('SELECT DISTINCT person_id FROM contestant WHERE subcontest_id = %s AND id > %s AND id <= %s', r)
+            personIds = [pid for pid, in cur]
+            cur.execute('DELETE f FROM contestant_field f JOIN contestant c ON c.id = f.contestant_id WHERE c.subcontest_id = %s AND c.id > %s AND c.id <= %s', r)
+            counts['contestant_field'] += cur.rowcount
+            cur.execute('DELETE m FROM mentor m JOIN contestant c ON c.id = m.contestant_id WHERE c.subcontest_id = %s AND c.id > %s AND c.id <= %s', r)
+            counts['mentor'] += cur.rowcount
+            cur.execute('DELETE FROM contestant WHERE subcontest_id = %s AND id > %s AND id <= %s', r)
+            counts['contestant'] += cur.rowcount
+            # in the same transaction, so that the statistics stay correct
+            # even if the deletion is interrupted
+            summaries.refreshSchoolStats(cur, schoolIds)
+            summaries.refreshPersonStats(cur, personIds)
+            conn.commit()
+            lastId = chunk[-1]
+            progress(f'Subcontest {id}: {counts["contestant"]} contestants deleted')
+
+    if ids:
+        cur.execute('DELETE FROM subcontest_column WHERE subcontest_id IN ' + inList(ids), params(ids))
+        counts['subcontest_column'] += cur.rowcount
+        cur.execute('DELETE FROM subcontest WHERE id IN ' + inList(ids), params(ids))
+        counts['subcontest'] += cur.rowcount
+        summaries.refreshFullSubcontest(cur, ids)
+    if contestIds:
+        cur.execute('DELETE FROM contest WHERE id IN ' + inList(contestIds) +
+                    ' AND NOT EXISTS (SELECT 1 FROM subcontest sc WHERE sc.contest_id = contest.id)', params(contestIds))
+        counts['contest'] += cur.rowcount
+    conn.commit()
+    print()
+    return counts
+
+"""
+Delete the given people and schools if they are still unreferenced
+"""
+def collectGarbage(conn, cur, people, schools):
+    counts = {'person': 0, 'school': 0}
+    for chunk in chunks(people, CHUNK_SIZE):
+        cur.execute('DELETE p FROM person p'
+                    ' LEFT JOIN contestant c ON c.person_id = p.id'
+                    ' LEFT JOIN mentor m ON m.mentor_id = p.id'
+                    ' LEFT JOIN person_alias a ON a.person_id = p.id'
+                    ' WHERE p.id IN ' + inList(chunk) + ' AND c.id IS NULL AND m.mentor_id IS NULL AND a.id IS NULL', params(chunk))
+        counts['person'] += cur.rowcount
+        # whatever was deleted of the chunk is gone from the search index too
+        summaries.unindexDeletedPeople(cur, chunk)
+        conn.commit()
+    for chunk in chunks(schools, CHUNK_SIZE):
+        cur.execute('DELETE s FROM school s'
+                    ' LEFT JOIN contestant c ON c.school_id = s.id'
+                    ' LEFT JOIN school_alias a ON a.correct = s.id'
+                    ' WHERE s.id IN ' + inList(chunk) + ' AND c.id IS NULL AND a.correct IS NULL', params(chunk))
+        counts['school'] += cur.rowcount
+        conn.commit()
+    return counts
+
+def printCounts(counts):
+    for table, count in counts.items():
+        print(f'  {table}: {count}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete subcontests and all of their data')
+    parser.add_argument('ids', nargs='*', type=int, help='Subcontest ids')
+    parser.add_argument('-c', '--contest', action='append', type=int, default=[], help='Delete this contest and all of its subcontests')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only show what would be deleted')
+    parser.add_argument('--gc', action='store_true', help='Also delete people and schools left without references')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='Contestants deleted per transaction')
+    args = parser.parse_args()
+
+    if not args.ids and not args.contest:
+        print("Missing id")
+        sys.exit(1)
+
+    conn = db.connection()
+    cur = conn.cursor()
+
+    subcontests, missing, missingContests = findSubcontests(cur, args.ids, args.contest)
+    for id in missing:
+        print(f'No subcontest with id {id}')
+    for id in missingContests:
+        print(f'No contest with id {id}')
+    if missing or missingContests:
+        sys.exit(1)
+
+    ids = [sc[0] for sc in subcontests]
+    for id, name, contestName in subcontests:
+        print(f'{id}: "{contestName} {name}"')
+
+    print('Rows to delete:')
+    counts = countRows(cur, ids)
+    counts['contest'] = len(args.contest)
+    printCounts(counts)
+    if args.gc:
+        people, schools = referencedIds(cur, ids)
+        orphanPeople, orphanSchools = orphans(cur, ids, people, schools)
+        printCounts({'person': len(orphanPeople), 'school': len(orphanSchools)})
+    # don't keep a transaction open while waiting for the answer
+    conn.rollback()
+
+    if args.dry_run:
+        print('Dry run, nothing deleted')
+        sys.exit(0)
+
+    what = [f'{len(ids)} subcontest' + ('' if len(ids) == 1 else 's')]
+    if args.contest:
+        what.append(f'{len(args.contest)} contest' + ('' if len(args.contest) == 1 else 's'))
+    ans = input('Delete ' + ' and '.join(what) + '? ')
+    print(ans)
+    if ans.upper() != 'YES':
+        print('Cancel')
+        sys.exit(0)
+
+    counts = deleteSubcontests(conn, cur, ids, args.chunk, args.contest)
+    if args.gc:
+        counts.update(collectGarbage(conn, cur, orphanPeople, orphanSchools))
+    print('Deleted:')
+    printCounts(counts)
+
+    print("Done")
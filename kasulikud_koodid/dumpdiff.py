@@ -0,0 +1,224 @@
+"""
+Compare two mysqldump files row by row, without a database server.
+
+Rows are matched by the primary key of their table (`contestant_field` and
+`mentor` have composite ones; a table without a primary key is keyed by its
+whole rows), and the inserted, deleted and updated rows of every table are
+counted. The differences can also be written as a delta file: SQL that turns
+a database restored from the old dump into the new one (DELETEs for the
+deleted rows, REPLACE for the inserted and updated ones).
+
+To run in bounded memory, the rows of both dumps are first streamed (see
+dumpfile.py) into partitions on the disk by a hash of their key, and then
+the partitions are compared one at a time: only one partition of the old
+dump is ever held in memory. The number of partitions grows with the size of
+the dumps (see --memory).
+
+Examples:
+    python3 dumpdiff.py ../backups/eoa09012021.sql ../backups/eoa18022021.sql
+    python3 dumpdiff.py old.sql new.sql -o delta.sql
+    mysql eoa < delta.sql
+"""
+
+import os
+import sys
+import math
+import zlib
+import pickle
+import argparse
+import tempfile
+
+import dumpfile
+
+# roughly how much larger the rows of a partition are in memory than in the dump
+MEMORY_FACTOR = 10
+
+# size of the REPLACE statements of the delta, as in mysqldump
+STATEMENT_SIZE = 1 << 20
+
+# deleted keys per DELETE statement
+DELETE_KEYS = 1000
+
+def partitionOf(key, partitions):
+    return zlib.crc32(repr(key).encode()) % partitions
+
+"""
+Split the rows of a dump into partition files in `directory` by their key
+Only the partition files of one table are open at a time.
+Returns a dictionary of table: {'columns', 'primary'}
+"""
+def partition(dump, directory, partitions):
+    tables = {}
+    files = None
+    current = None
+    try:
+        for kind, name, statement in dumpfile.read(dump):
+            if kind == 'table':
+                table = dumpfile.parseCreateTable(statement)
+                tables[name] = {'columns': [c for c, _ in table['columns']], 'primary': table['primary']}
+            elif kind == 'rows':
+                if name != current:
+                    if files is not None:
+                        for f in files:
+                            f.close()
+                    # append, in case the rows of a table are not all together
+                    files = [open(os.path.join(directory, f'{name}.{p}'), 'ab') for p in range(partitions)]
+                    current = name
+                columns = tables[name]['columns']
+                insertColumns = dumpfile.insertColumns(statement)
+                for row in dumpfile.parseRows(statement):
+                    if insertColumns is not None:
+                        values = dict(zip(insertColumns, row))
+                        row = tuple(values.get(c) for c in columns)
+                    key = rowKey(tables[name], row)
+                    pickle.dump((key, row), files[partitionOf(key, partitions)])
+    finally:
+        if files is not None:
+            for f in files:
+                f.close()
+    return tables
+
+"""
+Sort key of a primary key (or a whole row), with NULLs last
+"""
+def keyOrder(key):
+    return tuple((v is None, 0 if v is None else v) for v in key)
+
+def rowKey(table, row):
+    if not table['primary']:
+        return row
+    return tuple(row[table['columns'].index(c)] for c in table['primary'])
+
+def readPartition(directory, table, p):
+    try:
+        f = open(os.path.join(directory, f'{table}.{p}'), 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+"""
+Compare one partition of a table
+Returns (inserted, deleted, updated, unchanged), the first three as lists of
+rows (keys for the deleted ones) sorted by key
+"""
+def comparePartition(oldDir, newDir, table, p):
+    old = dict(readPartition(oldDir, table, p))
+    inserted, updated = [], []
+    unchanged = 0
+    for key, row in readPartition(newDir, table, p):
+        oldRow = old.pop(key, None)
+        if oldRow is None:
+            inserted.append((key, row))
+        elif oldRow != row:
+            updated.append((key, row))
+        else:
+            unchanged += 1
+    deleted = sorted(old, key=keyOrder)
+    byKey = lambda r: keyOrder(r[0])
+    return [row for _, row in sorted(inserted, key=byKey)], deleted, [row for _, row in sorted(updated, key=byKey)], unchanged
+
+class DeltaWriter:
+    """
+    Writes the differences of the tables as SQL
+    """
+    def __init__(self, f):
+        self.f = f
+        f.write('/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;\n')
+        f.write("/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;\n")
+        f.write('/*!50503 SET NAMES utf8mb4 */;\n')
+
+    def delete(self, table, primary, keys):
+        for i in range(0, len(keys), DELETE_KEYS):
+            chunk = keys[i:i + DELETE_KEYS]
+            if len(primary) == 1:
+                condition = f'`{primary[0]}` IN (' + ','.join(dumpfile.literal(k[0]) for k in chunk) + ')'
+            else:
+                # the whole row for tables without a primary key
+                condition = ' OR '.join('(' + ' AND '.join(f'`{c}` <=> {dumpfile.literal(v)}' for c, v in zip(primary, k)) + ')'
+                                        for k in chunk)
+            self.f.write(f'DELETE FROM `{table}` WHERE {condition};\n')
+
+    def replace(self, table, columns, rows):
+        start = f'REPLACE INTO `{table}` (' + ','.join(f'`{c}`' for c in columns) + ') VALUES '
+        values = []
+        size = 0
+        for row in rows:
+            v = '(' + ','.join(dumpfile.literal(x) for x in row) + ')'
+            if values and size + len(v) > STATEMENT_SIZE:
+                self.f.write(start + ','.join(values) + ';\n')
+                values, size = [], 0
+            values.append(v)
+            size += len(v) + 1
+        if values:
+            self.f.write(start + ','.join(values) + ';\n')
+
+    def close(self):
+        self.f.write('/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;\n')
+        self.f.write('/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;\n')
+
+"""
+Compare two dumps
+Writes the delta to `delta` (a file object) if given.
+Returns a dictionary of table: {'inserted', 'deleted', 'updated', 'unchanged'}
+"""
+def diff(oldDump, newDump, delta = None, partitions = None, memory = 256, tmp = None):
+    if partitions is None:
+        size = max(os.path.getsize(oldDump), os.path.getsize(newDump))
+        partitions = max(1, math.ceil(size * MEMORY_FACTOR / (memory << 20)))
+
+    counts = {}
+    writer = DeltaWriter(delta) if delta is not None else None
+    with tempfile.TemporaryDirectory(dir=tmp) as directory:
+        oldDir = os.path.join(directory, 'old')
+        newDir = os.path.join(directory, 'new')
+        os.mkdir(oldDir)
+        os.mkdir(newDir)
+        oldTables = partition(oldDump, oldDir, partitions)
+        newTables = partition(newDump, newDir, partitions)
+
+        for table in list(oldTables) + [t for t in newTables if t not in oldTables]:
+            info = newTables.get(table) or oldTables[table]
+            if table in oldTables and table in newTables and oldTables[table] != newTables[table]:
+                print(f'Warning: the columns or the primary key of {table} have changed, comparing the rows as they are',
+                      file=sys.stderr)
+            c = counts[table] = {'inserted': 0, 'deleted': 0, 'updated': 0, 'unchanged': 0}
+            for p in range(partitions):
+                inserted, deleted, updated, unchanged = comparePartition(oldDir, newDir, table, p)
+                c['inserted'] += len(inserted)
+                c['deleted'] += len(deleted)
+                c['updated'] += len(updated)
+                c['unchanged'] += unchanged
+                if writer is not None:
+                    oldInfo = oldTables.get(table, info)
+                    writer.delete(table, oldInfo['primary'] or oldInfo['columns'], deleted)
+                    if table in newTables:
+                        writer.replace(table, info['columns'], inserted + updated)
+    if writer is not None:
+        writer.close()
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two database dumps row by row')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the delta (SQL to apply on the old dump) to FILE')
+    parser.add_argument('-m', '--memory', type=int, default=256, help='Memory to aim for, in MB')
+    parser.add_argument('-p', '--partitions', type=int, default=None, help='Number of partitions (default: from --memory)')
+    parser.add_argument('--tmp', default=None, help='Directory for the partition files')
+    args = parser.parse_args()
+
+    delta = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        counts = diff(args.old, args.new, delta, args.partitions, args.memory, args.tmp)
+    finally:
+        if delta is not None:
+            delta.close()
+
+    print(f"{'table':<20} {'inserted':>9} {'deleted':>9} {'updated':>9} {'unchanged':>10}")
+    for table, c in counts.items():
+        print(f"{table:<20} {c['inserted']:>9} {c['deleted']:>9} {c['updated']:>9} {c['unchanged']:>10}")
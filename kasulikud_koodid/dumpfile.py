@@ -0,0 +1,149 @@
+"""
+Reading the mysqldump files in `backups/` without a MySQL server.
+
+A dump is read one statement at a time (mysqldump writes all the rows of a
+table as a few long INSERT lines), so the whole file is never in memory.
+`read` tells the statements apart, `parseCreateTable` and `parseRows` take
+the table definitions and rows out of them.
+"""
+
+import re
+
+# escapes in MySQL strings, as written by mysqldump; anything else after a
+# backslash stands for itself
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+# the characters mysqldump escapes in strings
+QUOTED = {'\\': '\\\\', "'": "\\'", '"': '\\"', '\0': '\\0', '\n': '\\n', '\r': '\\r', '\x1a': '\\Z'}
+
+# one token of the values of an INSERT: a string, NULL, a hex literal, a
+# number, punctuation or whitespace
+TOKEN = re.compile(r"'((?:[^'\\]|\\.|'')*)'|(NULL)|0x([0-9A-Fa-f]*)|([-+0-9.eE]+)|([(),;])|\s+", re.DOTALL)
+INTEGER = re.compile(r'[-+]?\d+')
+
+INSERT = re.compile(r'INSERT INTO `(\w+)`(?: \(([^)]*)\))? VALUES ')
+CREATE_TABLE = re.compile(r'CREATE TABLE (?:IF NOT EXISTS )?`?(\w+)`? \(')
+VIEW = re.compile(r'VIEW `(\w+)` AS (.*?)\s*\*/;$', re.DOTALL)
+
+"""
+The complete statements of a dump, without the comment lines
+"""
+def statements(f):
+    lines = []
+    for line in f:
+        if not lines and (line.startswith('--') or not line.strip()):
+            continue
+        lines.append(line.rstrip('\n'))
+        if line.rstrip().endswith(';'):
+            yield '\n'.join(lines)
+            lines = []
+
+"""
+Read a dump statement by statement
+Yields (kind, name, statement), where kind is
+  * 'table' for CREATE TABLE (see parseCreateTable)
+  * 'rows' for INSERT (see parseRows)
+  * 'view' for CREATE VIEW, with the SELECT of the view instead of the
+    statement (mysqldump first creates a placeholder view, then the real one)
+  * 'other' for everything else, with name None
+"""
+def read(filename):
+    with open(filename, encoding='utf-8') as f:
+        for statement in statements(f):
+            if m := INSERT.match(statement):
+                yield 'rows', m[1], statement
+            elif m := CREATE_TABLE.match(statement):
+                yield 'table', m[1], statement
+            elif 'CREATE' in statement and (m := VIEW.search(statement)):
+                yield 'view', m[1], m[2]
+            else:
+                yield 'other', None, statement
+
+def unescape(s):
+    if '\\' not in s and "''" not in s:
+        return s
+    return re.sub(r"\\(.)|''", lambda m: "'" if m[1] is None else ESCAPES.get(m[1], m[1]), s, flags=re.DOTALL)
+
+"""
+A value as a MySQL literal, the way mysqldump writes it
+"""
+def literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bytes):
+        return '0x' + value.hex().upper()
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + re.sub(r"[\\'\"\0\n\r\x1a]", lambda m: QUOTED[m[0]], value) + "'"
+
+def splitColumns(columns):
+    return [re.sub(r'\(\d+\)$', '', c.strip().strip('`')) for c in columns.split(',')]
+
+"""
+Parse the rows of an INSERT statement one at a time
+Yields a tuple for each row, with strings (dates too), ints, floats, bytes
+(hex literals) and None.
+"""
+def parseRows(statement):
+    m = INSERT.match(statement)
+    if m is None:
+        raise ValueError('Not an INSERT statement')
+    pos = m.end()
+    row = None
+    while pos < len(statement):
+        m = TOKEN.match(statement, pos)
+        if m is None:
+            raise ValueError(f'Unexpected {statement[pos:pos + 20]!r} in the values')
+        pos = m.end()
+        string, null, hexa, number, punctuation = m.groups()
+        if punctuation == '(':
+            row = []
+        elif punctuation == ')':
+            yield tuple(row)
+            row = None
+        elif punctuation == ';':
+            return
+        elif string is not None:
+            row.append(unescape(string))
+        elif null:
+            row.append(None)
+        elif hexa is not None:
+            row.append(bytes.fromhex(hexa))
+        elif number:
+            row.append(int(number) if INTEGER.fullmatch(number) else float(number))
+
+"""
+The column names of an INSERT statement, None if it doesn't list them (then
+the values are in the order of the CREATE TABLE)
+"""
+def insertColumns(statement):
+    m = INSERT.match(statement)
+    return None if m is None or m[2] is None else splitColumns(m[2])
+
+"""
+Parse a CREATE TABLE statement
+Returns a dictionary with
+  * 'name'
+  * 'columns': list of (name, definition), e.g. ('id', 'int NOT NULL AUTO_INCREMENT')
+  * 'primary': the columns of the primary key
+  * 'keys': list of (name, unique, columns) of the other indexes
+"""
+def parseCreateTable(statement):
+    m = CREATE_TABLE.match(statement)
+    if m is None:
+        raise ValueError('Not a CREATE TABLE statement')
+    table = {'name': m[1], 'columns': [], 'primary': [], 'keys': []}
+    # the table options after the closing parenthesis can contain anything
+    body = statement[m.end():statement.index('\n)', m.end())]
+    for line in body.split('\n'):
+        line = line.strip().rstrip(',')
+        if not line:
+            continue
+        if k := re.match(r'PRIMARY KEY \((.*)\)', line):
+            table['primary'] = splitColumns(k[1])
+        elif k := re.match(r'(UNIQUE )?KEY `?(\w+)`? \((.*)\)', line):
+            table['keys'].append((k[2], k[1] is not None, splitColumns(k[3])))
+        elif line.startswith(('CONSTRAINT', 'FOREIGN KEY', 'FULLTEXT', 'SPATIAL')):
+            continue
+        elif c := re.match(r'`?(\w+)`? (.*)', line):
+            table['columns'].append((c[1], c[2]))
+    return table
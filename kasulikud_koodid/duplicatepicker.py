@@ -1,52 +1,144 @@
+"""
+PERSON DUPLICATE REMOVAL TOOL
+
+Changes any references to the people selected in the "Choose" box to reference the one in the "Replacement" box, then deletes the people in the "Choose" box. "Find duplicates" and "Next cluster" step through likely duplicates found by personclusters.py; "Recompute" finds them again (e.g. after imports), instead of using the clusters file.
+
+The people are queried once at start and when the "Query all" button is pressed; merges are applied to the loaded data locally. They are kept in columns (one list per field) and only the rows visible on the screen are ever put into the list boxes, so that the tool stays responsive with hundreds of thousands of people.
+"""
+
 from tkinter import *
+import tkinter.font as tkfont
 import os
 import json
+import time
+import threading
+import queue
+from array import array
 from itertools import chain
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 logging.info('Running!')
 
-import mysql.connector
+import db
+import summaries
+import personclusters
 
-with open(os.path.join(os.path.dirname(__file__),"credentials.json")) as f:
-    config = json.loads(f.read())
-mysql_user = config["user"]
-mysql_passwd = config["password"]
-mysql_db = config["database"]
-mysql_host = config["host"]
-conn = mysql.connector.connect(user=mysql_user, password=mysql_passwd, database=mysql_db, host=mysql_host)
+# connects when the data is first queried
+conn = db.connection()
 cur = conn.cursor()
 
 #font = ("Ubuntu Mono", 12, "")
 font = "TkFixedFont"
 
-currData = []
+# People, one entry per column, in the order of the query
+ids = array('i')
+names = []
+upperNames = []
+subnames = []
+# id -> index in the columns
+indexOf = {}
+# 0 for people deleted (merged) since the query
+alive = bytearray()
+
+# indexes of the rows matching the search, in display order
 searchMap = []
+# first row of searchMap shown in the boxes
+offset = 0
+# indexes of the selected rows in each box (including ones scrolled out of view)
+selectedL = set()
+selectedR = set()
 maxL = [0, 0, 0]
 
+# merge candidates from personclusters, and the position of the shown one
+clusters = []
+clusterPos = -1
+# where the clusters came from, shown with them
+clusterSource = ''
+# results of computeClusters, see pollClusters
+clusterQueue = queue.Queue()
+
+# the query everything is loaded with (also run by benchmark.py)
+LOAD_QUERY = "SELECT id, name, UPPER(REGEXP_REPLACE(name, '[^[:alnum:]]+', '|')) subname FROM person ORDER BY subname"
+
 def getAll():
-    global maxL
-    query = "SELECT id, name, UPPER(REGEXP_REPLACE(name, '[^[:alnum:]]+', '|')) subname FROM person ORDER BY subname"
+    global maxL, alive
+    start = time.perf_counter()
+    query = LOAD_QUERY
     logging.info('Query: ' + repr(query))
     cur.execute(query)
-    currData.clear()
+    del ids[:]
+    names.clear()
+    upperNames.clear()
+    subnames.clear()
+    indexOf.clear()
     maxL = [0, 0, 0]
     for id, name, subname in cur:
-        currData.append((id, name, subname))
+        indexOf[id] = len(ids)
+        ids.append(id)
+        names.append(name)
+        upperNames.append(name.upper())
+        subnames.append(subname)
         for i, s in enumerate((str(id), name, subname)):
             maxL[i] = max(maxL[i], len(s))
-    
-    for id, name, subname in currData:
-        id, name, subname = (str(a).ljust(l) for a, l in zip((id, name, subname), maxL))
-        s = f'{id}    {name}    {subname}'
-        chooseBox.insert(END, s)
-        destBox.insert(END, s)
-
-    searchMap.clear()
-    chooseBox.selection_clear(0, END)
-    destBox.selection_clear(0, END)
+    alive = bytearray(b'\x01') * len(ids)
+    # end the read transaction, so that the next query sees new changes
+    conn.rollback()
+
+    selectedL.clear()
+    selectedR.clear()
     doSearch()
+    logging.info(f'Loaded {len(ids)} people in {time.perf_counter() - start:.3f} s')
+
+def formatRow(i):
+    id, name, subname = (str(a).ljust(l) for a, l in zip((ids[i], names[i], subnames[i]), maxL))
+    return f'{id}    {name}    {subname}'
+
+"""
+Number of rows that fit into the list boxes
+"""
+def visibleRows():
+    inset = int(chooseBox.cget('borderwidth')) + int(chooseBox.cget('highlightthickness'))
+    lineHeight = tkfont.nametofont(font).metrics('linespace') + 1
+    return max(1, (chooseBox.winfo_height() - 2 * inset) // lineHeight + 1)
+
+"""
+Put the visible part of searchMap into the list boxes
+"""
+def render(*_):
+    global offset
+    n = visibleRows()
+    offset = max(0, min(offset, len(searchMap) - n + 1))
+    rows = searchMap[offset:offset + n]
+    for box, selected in ((chooseBox, selectedL), (destBox, selectedR)):
+        box.delete(0, END)
+        box.insert(0, *(formatRow(i) for i in rows))
+        for pos, i in enumerate(rows):
+            if i in selected:
+                box.selection_set(pos)
+    if searchMap:
+        chooseScrollbar.set(offset / len(searchMap), min(1, (offset + n) / len(searchMap)))
+    else:
+        chooseScrollbar.set(0, 1)
+
+def scrollTo(newOffset):
+    global offset
+    offset = newOffset
+    render()
+
+"""
+Update the selection sets from the visible rows of a box
+"""
+def syncSelection(box, selected, single):
+    rows = searchMap[offset:offset + box.size()]
+    visible = set(box.curselection())
+    if single and visible:
+        selected.clear()
+    for pos, i in enumerate(rows):
+        if pos in visible:
+            selected.add(i)
+        else:
+            selected.discard(i)
 
 def message(text):
     popup = Toplevel(master)
@@ -65,11 +157,12 @@ def message(text):
     
 def replacePeople():
     try:
-        replacement = currData[searchMap[next(i for i in destBox.curselection())]]
+        replacementIndex = next(i for i in selectedR)
     except StopIteration:
         return
+    replacement = (ids[replacementIndex], names[replacementIndex])
 
-    people = [currData[searchMap[i]] for i in chooseBox.curselection() if currData[searchMap[i]] != replacement]
+    people = [(ids[i], names[i]) for i in sorted(selectedL) if i != replacementIndex]
     if len(people) == 0:
         return
     
@@ -92,15 +185,36 @@ def replacePeople():
         logging.debug('Query: ' + repr(query) + ', ' + repr(t))
         cur.execute(query, t)
         logging.debug('Affected: ' + str(cur.rowcount))
-        
+
+        # the participations of the merged people now all belong to the replacement
+        summaries.refreshPersonStats(cur, [replacement[0]] + [p[0] for p in people])
+        # which changes the number of distinct students of their schools
+        summaries.refreshSchoolStats(cur, summaries.personSchoolIds(cur, [replacement[0]]))
+        summaries.unindexPeople(cur, [p[0] for p in people])
+
         conn.commit()
-        
-        getAll()
+
+        # apply the merge locally instead of querying everything again
+        start = time.perf_counter()
+        removeLocal(p[0] for p in people)
+        logging.info(f'Refreshed in {time.perf_counter() - start:.3f} s')
     except Exception as e:
         conn.rollback()
         logging.exception('Exception when replacing:')
         message("Exception when replacing:\n" + str(e))
 
+"""
+Forget deleted people without querying the database
+"""
+def removeLocal(deletedIds):
+    global searchMap
+    for id in deletedIds:
+        alive[indexOf.pop(id)] = 0
+    selectedL.clear()
+    selectedR.clear()
+    searchMap = [i for i in searchMap if alive[i]]
+    render()
+
 def confirm(text, callback):
     popup = Toplevel(master)
     popup.wm_title("Confirm")
@@ -134,29 +248,116 @@ def confirm(text, callback):
     popup.grab_set()
 
 def doSearch(*_):
-    global searchMap
+    global searchMap, offset
     s = searchBox.get().upper()
     logging.debug(repr(s))
 
-    selectedL = set(searchMap[i] for i in chooseBox.curselection())
-    selectedR = set(searchMap[i] for i in destBox.curselection())
-    searchMap = [i for i, p in enumerate(currData) if i in selectedL or i in selectedR or s in str(p[0]) or s in p[1].upper()]
+    if s == '':
+        searchMap = [i for i in range(len(ids)) if alive[i]]
+    else:
+        searchMap = [i for i in range(len(ids)) if alive[i] and
+                     (i in selectedL or i in selectedR or s in str(ids[i]) or s in upperNames[i])]
+    offset = 0
+    render()
+
+def formatAge(seconds):
+    if seconds < 3600:
+        return f'{int(seconds // 60)} min'
+    if seconds < 86400:
+        return f'{int(seconds // 3600)} h'
+    return f'{int(seconds // 86400)} days'
+
+"""
+Load the duplicate clusters from the file written by personclusters.py (if
+there is one), or compute them and write the file, and show the first one
+People imported after the file was written are only in it once it is
+recomputed.
+"""
+def findClusters(recompute = False):
+    global clusters, clusterSource
+    if not recompute and os.path.exists(personclusters.CLUSTERS_FILE):
+        with open(personclusters.CLUSTERS_FILE) as f:
+            clusters = json.load(f)
+        age = time.time() - os.path.getmtime(personclusters.CLUSTERS_FILE)
+        clusterSource = f'from {os.path.basename(personclusters.CLUSTERS_FILE)}, {formatAge(age)} old'
+        showClusters()
+        return
+    findClustersButton.configure(state=DISABLED)
+    recomputeButton.configure(state=DISABLED)
+    clusterLabel.configure(text='Finding duplicates...')
+    threading.Thread(target=computeClusters, daemon=True).start()
+    master.after(100, pollClusters)
+
+"""
+Compute the clusters and write the file, on a separate thread (with its own
+connection) so that the window stays responsive
+Only reports back through clusterQueue, as Tk must not be used from here.
+"""
+def computeClusters():
+    workerConn = db.connection()
+    try:
+        found = personclusters.findClusters(workerConn.cursor())
+        workerConn.rollback()
+    except Exception as e:
+        logging.exception('Could not find the clusters')
+        clusterQueue.put(('error', str(e)))
+        return
+    finally:
+        workerConn.close()
+    try:
+        with open(personclusters.CLUSTERS_FILE, 'w') as f:
+            json.dump(found, f)
+    except OSError:
+        logging.exception('Could not write the clusters file')
+    clusterQueue.put(('done', found))
+
+def pollClusters():
+    global clusters, clusterSource
+    try:
+        kind, value = clusterQueue.get_nowait()
+    except queue.Empty:
+        master.after(100, pollClusters)
+        return
+    findClustersButton.configure(state=NORMAL)
+    recomputeButton.configure(state=NORMAL)
+    if kind == 'error':
+        clusterLabel.configure(text='')
+        message('Could not find the duplicates:\n' + value)
+        return
+    clusters = value
+    clusterSource = 'just computed'
+    showClusters()
+
+def showClusters():
+    global clusterPos
+    clusterPos = -1
+    nextCluster()
+
+"""
+Show only the people of the next cluster, with the one with the most
+participations selected as the replacement and the rest as the duplicates
+"""
+def nextCluster():
+    global clusterPos, searchMap, offset
+    while clusterPos + 1 < len(clusters):
+        clusterPos += 1
+        # people merged away since the clusters were computed are gone
+        members = [indexOf[id] for id in clusters[clusterPos]['ids'] if id in indexOf]
+        if len(members) >= 2:
+            break
+    else:
+        message('No more clusters')
+        return
+
+    searchMap = members
+    selectedL.clear()
+    selectedL.update(members[1:])
+    selectedR.clear()
+    selectedR.add(members[0])
+    offset = 0
+    render()
+    clusterLabel.configure(text=f'Cluster {clusterPos + 1}/{len(clusters)}, score {clusters[clusterPos]["score"]:.1f} ({clusterSource})')
 
-    chooseBox.delete(0, END)
-    destBox.delete(0, END)
-    
-    for i in searchMap:
-        t = currData[i]
-        id, name, subname = (str(a).ljust(l) for a, l in zip(t, maxL))
-        s = f'{id}    {name}    {subname}'
-        chooseBox.insert(END, s)
-        destBox.insert(END, s)
-        if i in selectedL:
-            chooseBox.selection_set(END)
-        if i in selectedR:
-            destBox.selection_set(END)
-    
-    
 master = Tk()
 
 master.geometry('1200x800+400+200')
@@ -188,18 +389,23 @@ destBoxFrame.rowconfigure(0, weight=1)
 chooseScrollbar = Scrollbar(chooseFrame, orient="vertical")
 
 def scrollFromBar(*args):
-    chooseBox.yview(*args)
-    destBox.yview(*args)
+    if args[0] == 'moveto':
+        scrollTo(int(float(args[1]) * len(searchMap)))
+    elif args[0] == 'scroll':
+        scrollTo(offset + int(args[1]) * (visibleRows() if args[2] == 'pages' else 1))
+
+def scrollFromWheel(event):
+    scrollTo(offset + (-3 if event.num == 4 or event.delta > 0 else 3))
+    return 'break'
 
-def scrollFromBox(*args):
-    chooseScrollbar.set(*args)
-    chooseBox.yview_moveto(args[0])
-    destBox.yview_moveto(args[0])
-    
 chooseScrollbar.config(command=scrollFromBar)
 chooseScrollbar.grid(row=0, column=3, sticky=N+S)
-chooseBox.config(yscrollcommand=scrollFromBox)
-destBox.config(yscrollcommand=scrollFromBox)
+for box in (chooseBox, destBox):
+    for event in ('<Button-4>', '<Button-5>', '<MouseWheel>'):
+        box.bind(event, scrollFromWheel)
+chooseBox.bind('<<ListboxSelect>>', lambda *_: syncSelection(chooseBox, selectedL, False))
+destBox.bind('<<ListboxSelect>>', lambda *_: syncSelection(destBox, selectedR, True))
+chooseBox.bind('<Configure>', render)
 
 ##############################################################
 
@@ -215,7 +421,7 @@ queryAll = Button(buttonFrame, text="Query all", command=getAll)
 queryAll.grid(row=0, column=0)
 
 def replaceCommand():
-    count = len(chooseBox.curselection())
+    count = len(selectedL - selectedR)
     confirm(f'Are you sure?\nReplacing {count} row' + ('' if count == 1 else 's') + '.', replacePeople)
 
 replaceButton = Button(buttonFrame, text="Replace", command=replaceCommand)
@@ -227,6 +433,15 @@ searchVar.trace_add("write", doSearch)
 searchBox = Entry(buttonFrame, textvariable=searchVar)
 searchBox.grid(row=0, column=2, sticky=E+W)
 
+findClustersButton = Button(buttonFrame, text="Find duplicates", command=findClusters)
+findClustersButton.grid(row=0, column=3)
+nextClusterButton = Button(buttonFrame, text="Next cluster", command=nextCluster)
+nextClusterButton.grid(row=0, column=4)
+recomputeButton = Button(buttonFrame, text="Recompute", command=lambda: findClusters(True))
+recomputeButton.grid(row=0, column=5)
+clusterLabel = Label(buttonFrame, text='')
+clusterLabel.grid(row=0, column=6)
+
 buttonFrame.columnconfigure(0, weight=0)
 buttonFrame.columnconfigure(1, weight=0)
 buttonFrame.columnconfigure(2, weight=1)
@@ -236,6 +451,7 @@ master.columnconfigure(0, weight=1)
 master.rowconfigure(0, weight=1)
 master.rowconfigure(1, weight=0)
 
-getAll()
+# query once the window is shown
+master.after(100, getAll)
 
 mainloop()
@@ -0,0 +1,182 @@
+"""
+Find clusters of people that are likely duplicates of each other, for
+`duplicatepicker.py` to step through.
+
+Names are folded (diacritics removed, uppercase, tokens sorted), so that e.g.
+"Mägi Mari" and "Mari Magi" get the same key. People are then blocked by their
+key and every variant of it with one character deleted: two keys within one
+edit of each other always share a block, and blocks stay small, so only a
+near-linear number of pairs is compared instead of all of them.
+
+Candidate pairs are scored by how close the names are, and by what is known
+about the people from `contestant`: a shared school or a consistent class
+progression (class - year) makes a duplicate more likely, taking part in the
+same subcontest rules it out.
+
+Can be run on its own to write the clusters into a JSON file:
+    python3 personclusters.py [person_clusters.json]
+"""
+
+import sys
+import os
+import json
+import logging
+import unicodedata
+from collections import defaultdict
+
+# blocks with more people than this are skipped (there is no useful
+# information in them and they would make the comparison quadratic)
+MAX_BLOCK = 100
+
+# default location of the clusters file
+CLUSTERS_FILE = os.path.join(os.path.dirname(__file__), "person_clusters.json")
+
+def foldName(name):
+    s = unicodedata.normalize('NFKD', name.upper())
+    s = ''.join(c if c.isalnum() else ' ' for c in s if not unicodedata.combining(c))
+    return ' '.join(sorted(s.split()))
+
+def deletions(s):
+    return {s} | {s[:i] + s[i+1:] for i in range(len(s))}
+
+def withinOneEdit(a, b):
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i+1:] == b[i+1:]
+    return a[i:] == b[i+1:]
+
+"""
+Pairs of indexes into `keys` whose keys are within one edit of each other
+"""
+def candidatePairs(keys):
+    blocks = defaultdict(list)
+    for i, key in enumerate(keys):
+        for d in deletions(key):
+            blocks[d].append(i)
+
+    pairs = set()
+    for d, block in blocks.items():
+        if len(block) > MAX_BLOCK:
+            logging.warning(f'Skipping block {d!r} with {len(block)} people')
+            continue
+        for x in range(len(block)):
+            for y in range(x + 1, len(block)):
+                i, j = block[x], block[y]
+                if keys[i] != keys[j] and not withinOneEdit(keys[i], keys[j]):
+                    continue
+                pairs.add((min(i, j), max(i, j)))
+    return pairs
+
+"""
+Read people and their participations from the database
+Returns a list of dictionaries with 'id', 'name', 'schools', 'subcontests',
+'gradYears' (year + 12 - class for each participation) and 'count'
+"""
+def loadPeople(cur):
+    people = {}
+    cur.execute("SELECT id, name FROM person")
+    for id, name in cur:
+        people[id] = {'id': id, 'name': name, 'schools': set(), 'subcontests': set(), 'gradYears': set(), 'count': 0}
+
+    cur.execute("SELECT co.person_id, co.school_id, co.subcontest_id, a.min_class, a.max_class, fs.y_name "
+                "FROM contestant co "
+                "LEFT JOIN age_group a ON a.id = co.age_group_id "
+                "LEFT JOIN full_subcontest fs ON fs.sc_id = co.subcontest_id")
+    for personId, schoolId, subcontestId, minClass, maxClass, year in cur:
+        p = people.get(personId)
+        if p is None:
+            continue
+        p['count'] += 1
+        p['subcontests'].add(subcontestId)
+        if schoolId is not None:
+            p['schools'].add(schoolId)
+        # only single class age groups say anything about the person
+        if minClass is not None and minClass == maxClass and year:
+            p['gradYears'].add(int(str(year)[:4]) + 12 - minClass)
+    return list(people.values())
+
+"""
+Score a candidate pair, None if they can't be the same person
+"""
+def scorePair(a, b, keyA, keyB):
+    if a['subcontests'] & b['subcontests']:
+        return None
+    score = 1.0 if keyA == keyB else 0.6
+    if a['schools'] & b['schools']:
+        score += 0.5
+    if a['gradYears'] and b['gradYears']:
+        if any(abs(x - y) <= 1 for x in a['gradYears'] for y in b['gradYears']):
+            score += 0.5
+        else:
+            score -= 0.5
+    return score
+
+"""
+Find the clusters of likely duplicates
+Returns a list of dictionaries with 'ids' (most participations first) and
+'score', best clusters first
+"""
+def findClusters(cur):
+    people = loadPeople(cur)
+    keys = [foldName(p['name']) for p in people]
+
+    # union-find over the accepted pairs
+    parent = list(range(len(people)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    scored = []
+    for i, j in candidatePairs(keys):
+        score = scorePair(people[i], people[j], keys[i], keys[j])
+        if score is not None:
+            scored.append((score, i, j))
+
+    # best pairs first, and never join clusters that would then contain two
+    # people from the same subcontest
+    subcontests = [p['subcontests'] for p in people]
+    scores = {}
+    for score, i, j in sorted(scored, reverse=True):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            if subcontests[ri] & subcontests[rj]:
+                continue
+            parent[ri] = rj
+            subcontests[rj] = subcontests[ri] | subcontests[rj]
+        scores[(i, j)] = score
+
+    clusterScores = defaultdict(float)
+    for (i, j), score in scores.items():
+        r = find(i)
+        clusterScores[r] = max(clusterScores[r], score)
+
+    members = defaultdict(list)
+    for i in range(len(people)):
+        if find(i) in clusterScores:
+            members[find(i)].append(people[i])
+
+    clusters = []
+    for r, ms in members.items():
+        ms.sort(key=lambda p: -p['count'])
+        clusters.append({'ids': [p['id'] for p in ms], 'score': clusterScores[r]})
+    clusters.sort(key=lambda c: -c['score'])
+    logging.info(f'{len(clusters)} clusters found among {len(people)} people')
+    return clusters
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    import db
+
+    clusters = findClusters(db.connection().cursor())
+    with open(sys.argv[1] if len(sys.argv) > 1 else CLUSTERS_FILE, 'w') as f:
+        json.dump(clusters, f)
@@ -10,27 +10,23 @@ USAGE:
 2. select the replacement school from the "Replacement" list. Note that the chosen school should *not* be selected in the "Choose" list
 3. press the "Replace" button and confirm the replacement
 
-The search box searches from the id, original name and a "normalized" name (all uppercase with non-letter characters removed). Entries are sorted by the "normalized" name.
+Alternatively, press "Queue" instead of "Replace" to stage the replacement and continue with the next one. "Apply queue" then does all of the staged replacements at once, in a single transaction. Only the frequencies of the replacement schools are queried again afterwards.
+
+The search box searches from the id and a "normalized" name (all uppercase with non-letter characters removed), using a trigram index built when the data is queried. Exact matches are listed first (sorted by the "normalized" name), followed by similarly named schools. Selected schools are always kept at the top of the list; with an empty search box, the schools most similar to the first selected one in the "Choose" list are shown right after them, as they are the most likely duplicates.
 """
 
 from tkinter import *
-import os
-import json
-from itertools import chain
+from collections import Counter
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 logging.info('Running!')
 
-import mysql.connector
+import db
+import summaries
 
-with open(os.path.join(os.path.dirname(__file__),"credentials.json")) as f:
-    config = json.loads(f.read())
-mysql_user = config["user"]
-mysql_passwd = config["password"]
-mysql_db = config["database"]
-mysql_host = config["host"]
-conn = mysql.connector.connect(user=mysql_user, password=mysql_passwd, database=mysql_db, host=mysql_host)
+# connects when the data is first queried
+conn = db.connection()
 cur = conn.cursor()
 
 #font = ("Ubuntu Mono", 12, "")
@@ -38,23 +34,144 @@ font = "TkFixedFont"
 
 currData = []
 searchMap = []
+lines = []
 maxL = [0, 0, 0]
 
+# trigram -> indexes in currData of the schools whose subname contains it
+trigramIndex = {}
+# number of distinct trigrams in each subname
+trigramCounts = []
+# id (as a string) -> index in currData
+idIndex = {}
+
+# delay after the last keystroke before searching, in ms
+SEARCH_DELAY = 150
+searchJob = None
+
+def normalize(s):
+    return ''.join(c for c in s.upper() if c.isalnum())
+
+def trigrams(s):
+    if len(s) < 3:
+        return {s} if s else set()
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+def buildIndex():
+    trigramIndex.clear()
+    trigramCounts.clear()
+    idIndex.clear()
+    for i, (id, name, subname, freq) in enumerate(currData):
+        ts = trigrams(subname or '')
+        trigramCounts.append(len(ts))
+        idIndex[str(id)] = i
+        for t in ts:
+            trigramIndex.setdefault(t, []).append(i)
+
+"""
+Indexes of the schools sharing trigrams with `s`, best matches first
+
+With `dice`, the score is the Dice coefficient of the two trigram sets
+(for comparing whole names), otherwise the fraction of the trigrams of `s`
+that the school has (for comparing a search against names)
+"""
+def similar(s, minScore, dice = False):
+    ts = trigrams(s)
+    if not ts:
+        return []
+    counts = Counter()
+    for t in ts:
+        counts.update(trigramIndex.get(t, ()))
+    scored = []
+    for i, n in counts.items():
+        score = 2 * n / (len(ts) + trigramCounts[i]) if dice else n / len(ts)
+        if score >= minScore:
+            scored.append((-score, i))
+    scored.sort()
+    return [i for _, i in scored]
+
+"""
+Indexes of the schools matching the search, ranked
+`reference` is the subname of the school to find duplicates of, if any
+"""
+def search(query, reference = None):
+    q = normalize(query)
+    if not q:
+        result = list(range(len(currData)))
+        if reference:
+            duplicates = similar(reference, 0.5, dice = True)
+            duplicateSet = set(duplicates)
+            result = duplicates + [i for i in result if i not in duplicateSet]
+    elif len(q) < 3:
+        # too short for the index, but then most of the list matches anyway
+        result = [i for i, p in enumerate(currData) if q in p[2]]
+    else:
+        # every trigram of the query has to be in the name for it to contain
+        # the query, so start from the shortest posting list
+        postings = sorted((trigramIndex.get(t, []) for t in trigrams(q)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        exact = sorted(i for i in candidates if q in currData[i][2])
+        exactSet = set(exact)
+        result = exact + [i for i in similar(q, 0.6) if i not in exactSet]
+
+    if query.strip() in idIndex:
+        i = idIndex[query.strip()]
+        result = [i] + [j for j in result if j != i]
+    return result
+
+# the query everything is loaded with (also run by benchmark.py)
+LOAD_QUERY = "SELECT id, name, UPPER(REGEXP_REPLACE(name, '[^[:alnum:]]+', '')) subname, COALESCE(school_stats.participations, 0) freq FROM school LEFT JOIN school_stats ON school_stats.school_id = school.id ORDER BY subname"
+# the same, counting the participations on the fly, until school_stats has
+# been created (see summaries.py)
+LOAD_QUERY_WITHOUT_STATS = "SELECT id, name, UPPER(REGEXP_REPLACE(name, '[^[:alnum:]]+', '')) subname, (SELECT COUNT(*) FROM contestant WHERE contestant.school_id = school.id) freq FROM school ORDER BY subname"
+
 def getAll():
     global maxL
-    query = "SELECT id, name, UPPER(REGEXP_REPLACE(name, '[^[:alnum:]]+', '')) subname, (SELECT COUNT(*) FROM contestant WHERE contestant.school_id = school.id) freq FROM school ORDER BY subname"
+    query = LOAD_QUERY if summaries.isCreated(cur, 'school_stats') else LOAD_QUERY_WITHOUT_STATS
     logging.info('Query: ' + repr(query))
     cur.execute(query)
+    selected = selectedIds()
     currData.clear()
     maxL = [0, 0, 0, 0]
     for id, name, subname, freq in cur:
         currData.append((id, name, subname, freq))
         for i, s in enumerate((str(id), name, subname, str(freq))):
             maxL[i] = max(maxL[i], len(s))
+    # end the read transaction, so that the next query sees new changes
+    conn.rollback()
 
-    searchMap.clear()
-    chooseBox.selection_clear(0, END)
-    destBox.selection_clear(0, END)
+    dataChanged(selected)
+
+"""
+The ids of the schools selected in each box, to select them again after
+currData has changed (see dataChanged)
+"""
+def selectedIds():
+    return ([currData[searchMap[i]][0] for i in chooseBox.curselection()],
+            [currData[searchMap[i]][0] for i in destBox.curselection()])
+
+"""
+Rebuild everything derived from currData and show it, with the schools
+selected before (see selectedIds) still selected if they are there
+"""
+def dataChanged(selected = ((), ())):
+    lines.clear()
+    for t in currData:
+        id, name, subname, freq = (str(a).ljust(l) for a, l in zip(t, maxL))
+        lines.append(f'id:{id} #:{freq}    {name}    {subname}')
+    buildIndex()
+
+    # the indexes in currData have changed, so nothing in the boxes is valid;
+    # only the selected schools are put back, doSearch adds the rest after them
+    selectedL = [idIndex[str(id)] for id in selected[0] if str(id) in idIndex]
+    selectedR = [idIndex[str(id)] for id in selected[1] if str(id) in idIndex]
+    searchMap[:] = selectedL + [i for i in selectedR if i not in selectedL]
+    for box, boxSelected in ((chooseBox, selectedL), (destBox, selectedR)):
+        box.delete(0, END)
+        if searchMap:
+            box.insert(0, *(lines[i] for i in searchMap))
+        for pos, i in enumerate(searchMap):
+            if i in boxSelected:
+                box.selection_set(pos)
     doSearch()
 
 def message(text):
@@ -72,53 +189,139 @@ def message(text):
     button = Button(popup, text='OK', command=okCallback)
     button.pack(side=BOTTOM, fill=X)
 
-def replaceSchools(saveAlias):
+# staged replacements: school id -> (replacement id, school name, saveAlias)
+mergeQueue = {}
+
+"""
+Get the selected replacement and the schools to replace with it, as
+(replacement, schools), or None if there's nothing to do
+"""
+def selectedMerge():
     try:
         replacement = currData[searchMap[next(i for i in destBox.curselection())]]
     except StopIteration:
-        return
+        return None
 
     schools = [currData[searchMap[i]] for i in chooseBox.curselection() if currData[searchMap[i]] != replacement]
     if len(schools) == 0:
+        return None
+    return replacement, schools
+
+def replaceSchools(saveAlias):
+    merge = selectedMerge()
+    if merge is None:
         return
+    replacement, schools = merge
+    applyMerges({p[0]: (replacement[0], p[1], saveAlias) for p in schools})
 
-    logging.debug(f'schools: {schools}, replacement: {replacement}')
+def queueSchools(saveAlias):
+    merge = selectedMerge()
+    if merge is None:
+        return
+    replacement, schools = merge
+    logging.debug(f'queued schools: {schools}, replacement: {replacement}')
+    for p in schools:
+        mergeQueue[p[0]] = (replacement[0], p[1], saveAlias)
+    chooseBox.selection_clear(0, END)
+    destBox.selection_clear(0, END)
+    queueChanged()
 
-    try:
-        school_tuple = '(' + ', '.join('%s' for _ in schools) + ')'
+def clearQueue():
+    mergeQueue.clear()
+    queueChanged()
 
-        query = 'UPDATE school_alias SET correct = %s WHERE correct IN ' + school_tuple
-        t = tuple(map(str, chain([replacement[0]], (p[0] for p in schools))))
-        logging.debug('Query: ' + repr(query) + ', ' + repr(t))
-        cur.execute(query, t)
-        logging.debug('Affected: ' + str(cur.rowcount))
+def queueChanged():
+    applyQueueButton.configure(text=f'Apply queue ({len(mergeQueue)})')
 
-        if saveAlias:
-            query = 'REPLACE INTO school_alias(name, correct) VALUES (%s, %s)'
-            t = [(p[1], replacement[0]) for p in schools]
+"""
+Follow chains of replacements (a -> b, b -> c becomes a -> c, b -> c)
+"""
+def resolveMerges(merges):
+    resolved = {}
+    for old, (new, name, saveAlias) in merges.items():
+        seen = {old}
+        while new in merges:
+            if new in seen:
+                raise Exception(f'Circular replacement of school {old}')
+            seen.add(new)
+            new = merges[new][0]
+        resolved[old] = (new, name, saveAlias)
+    return resolved
+
+def executeLogged(query, t = ()):
+    logging.debug('Query: ' + repr(query) + ', ' + repr(t))
+    cur.execute(query, t)
+    logging.debug('Affected: ' + str(cur.rowcount))
+
+"""
+Do the given replacements (school id -> (replacement id, school name,
+saveAlias)) in one transaction, using a temporary table of the replacements
+"""
+def applyMerges(merges):
+    try:
+        merges = resolveMerges(merges)
+        logging.debug(f'merges: {merges}')
+
+        executeLogged('CREATE TEMPORARY TABLE school_merge (old_id INT PRIMARY KEY, new_id INT NOT NULL, name VARCHAR(64) NOT NULL, save_alias BOOL NOT NULL)')
+        try:
+            query = 'INSERT INTO school_merge (old_id, new_id, name, save_alias) VALUES (%s, %s, %s, %s)'
+            t = [(str(old), str(new), name, saveAlias) for old, (new, name, saveAlias) in merges.items()]
             logging.debug('Query: ' + repr(query) + ', ' + repr(t))
             cur.executemany(query, t)
-            logging.debug('Affected: ' + str(cur.rowcount))
 
-        query = 'UPDATE contestant SET school_id = %s WHERE school_id IN '  + school_tuple
-        t = tuple(map(str, chain([replacement[0]], (p[0] for p in schools))))
-        logging.debug('Query: ' + repr(query) + ', ' + repr(t))
-        cur.execute(query, t)
-        logging.debug('Affected: ' + str(cur.rowcount))
+            executeLogged('UPDATE school_alias a JOIN school_merge m ON a.correct = m.old_id SET a.correct = m.new_id')
+            executeLogged('REPLACE INTO school_alias(name, correct) SELECT name, new_id FROM school_merge WHERE save_alias')
+            executeLogged('UPDATE contestant c JOIN school_merge m ON c.school_id = m.old_id SET c.school_id = m.new_id')
+            executeLogged('DELETE s FROM school s JOIN school_merge m ON s.id = m.old_id')
+        finally:
+            executeLogged('DROP TEMPORARY TABLE school_merge')
 
-        query = 'DELETE FROM school WHERE id in (' + ', '.join('%s' for _ in schools) + ')'
-        t = tuple(str(p[0]) for p in schools)
-        logging.debug('Query: ' + repr(query) + ', ' + repr(t))
-        cur.execute(query, t)
-        logging.debug('Affected: ' + str(cur.rowcount))
+        summaries.refreshSchoolStats(cur, set(merges) | set(new for new, _, _ in merges.values()))
 
         conn.commit()
-
-        getAll()
+        # the rest of the queue stays, pointing to where its replacements went
+        for old in merges:
+            mergeQueue.pop(old, None)
+        for old, (new, name, saveAlias) in mergeQueue.items():
+            if new in merges:
+                mergeQueue[old] = (merges[new][0], name, saveAlias)
+        queueChanged()
     except Exception as e:
         logging.exception('Exception when replacing:')
         conn.rollback()
         message("Exception when replacing:\n" + str(e))
+        return
+
+    try:
+        refreshMerged(merges)
+    except Exception as e:
+        logging.exception('Exception when refreshing:')
+        conn.rollback()
+        message('The schools were replaced, but the list could not be updated ("Query all" loads it again):\n' + str(e))
+
+"""
+Apply done replacements to the loaded data, only querying the frequencies of
+the replacement schools
+"""
+def refreshMerged(merges):
+    replacements = set(new for new, _, _ in merges.values())
+    if summaries.isCreated(cur, 'school_stats'):
+        query = 'SELECT school_id, participations FROM school_stats WHERE school_id IN (' + ', '.join('%s' for _ in replacements) + ')'
+    else:
+        query = 'SELECT school_id, COUNT(*) FROM contestant WHERE school_id IN (' + ', '.join('%s' for _ in replacements) + ') GROUP BY school_id'
+    t = tuple(str(r) for r in replacements)
+    logging.debug('Query: ' + repr(query) + ', ' + repr(t))
+    cur.execute(query, t)
+    freqs = dict(cur.fetchall())
+    conn.rollback()
+
+    selected = selectedIds()
+    currData[:] = [(id, name, subname, freqs.get(id, 0) if id in replacements else freq)
+                   for id, name, subname, freq in currData if id not in merges]
+    for t in currData:
+        if t[0] in replacements:
+            maxL[3] = max(maxL[3], len(str(t[3])))
+    dataChanged(selected)
 
 def confirm(text, callback):
     popup = Toplevel(master)
@@ -152,28 +355,55 @@ def confirm(text, callback):
 
     popup.grab_set()
 
-def doSearch(*_):
+def scheduleSearch(*_):
+    global searchJob
+    if searchJob is not None:
+        master.after_cancel(searchJob)
+    searchJob = master.after(SEARCH_DELAY, doSearch)
+
+"""
+Show the given rows in both boxes, only touching the rows that changed
+"""
+def updateBoxes(newMap):
     global searchMap
-    s = searchBox.get().upper()
+    old = searchMap
+    prefix = 0
+    while prefix < min(len(old), len(newMap)) and old[prefix] == newMap[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(old), len(newMap)) - prefix and old[-1 - suffix] == newMap[-1 - suffix]:
+        suffix += 1
+
+    changed = [lines[i] for i in newMap[prefix:len(newMap) - suffix]]
+    for box in (chooseBox, destBox):
+        if len(old) - suffix > prefix:
+            box.delete(prefix, len(old) - suffix - 1)
+        if changed:
+            box.insert(prefix, *changed)
+    searchMap = newMap
+
+def doSearch(*_):
+    global searchJob
+    searchJob = None
+    s = searchBox.get()
     logging.debug(repr(s))
 
-    selectedL = set(searchMap[i] for i in chooseBox.curselection())
-    selectedR = set(searchMap[i] for i in destBox.curselection())
-    searchMap = [i for i, p in enumerate(currData) if i in selectedL or i in selectedR or s in str(p[0]) or s in p[1].upper()]
+    selectedL = [searchMap[i] for i in chooseBox.curselection()]
+    selectedR = [searchMap[i] for i in destBox.curselection()]
+    reference = currData[selectedL[0]][2] if selectedL else None
 
-    chooseBox.delete(0, END)
-    destBox.delete(0, END)
+    # selected rows are always kept, at the top
+    selected = selectedL + [i for i in selectedR if i not in selectedL]
+    selectedSet = set(selected)
+    updateBoxes(selected + [i for i in search(s, reference) if i not in selectedSet])
 
-    for i in searchMap:
-        t = currData[i]
-        id, name, subname, freq = (str(a).ljust(l) for a, l in zip(t, maxL))
-        s = f'id:{id} #:{freq}    {name}    {subname}'
-        chooseBox.insert(END, s)
-        destBox.insert(END, s)
+    chooseBox.selection_clear(0, END)
+    destBox.selection_clear(0, END)
+    for pos, i in enumerate(selected):
         if i in selectedL:
-            chooseBox.selection_set(END)
+            chooseBox.selection_set(pos)
         if i in selectedR:
-            destBox.selection_set(END)
+            destBox.selection_set(pos)
 
 
 master = Tk()
@@ -220,6 +450,14 @@ chooseScrollbar.grid(row=0, column=3, sticky=N+S)
 chooseBox.config(yscrollcommand=scrollFromBox)
 destBox.config(yscrollcommand=scrollFromBox)
 
+def chooseSelected(*_):
+    # with an empty search, the likely duplicates of the first selected school
+    # are listed after it
+    if not normalize(searchBox.get()):
+        scheduleSearch()
+
+chooseBox.bind('<<ListboxSelect>>', chooseSelected)
+
 ##############################################################
 
 chooseFrame.columnconfigure(0, weight=1, uniform="group1")
@@ -242,8 +480,23 @@ replaceButton.grid(row=0, column=1)
 replaceNoaliasButton = Button(buttonFrame, text="Replace (no alias)", command=lambda: replaceCommand(False))
 replaceNoaliasButton.grid(row=0, column=2)
 
+def applyQueueCommand():
+    count = len(mergeQueue)
+    if count == 0:
+        return
+    confirm(f'Are you sure?\nReplacing {count} queued row' + ('' if count == 1 else 's') + '.', lambda: applyMerges(dict(mergeQueue)))
+
+queueButton = Button(buttonFrame, text="Queue", command=lambda: queueSchools(True))
+queueButton.grid(row=0, column=4)
+queueNoaliasButton = Button(buttonFrame, text="Queue (no alias)", command=lambda: queueSchools(False))
+queueNoaliasButton.grid(row=0, column=5)
+applyQueueButton = Button(buttonFrame, text="Apply queue (0)", command=applyQueueCommand)
+applyQueueButton.grid(row=0, column=6)
+clearQueueButton = Button(buttonFrame, text="Clear queue", command=clearQueue)
+clearQueueButton.grid(row=0, column=7)
+
 searchVar = StringVar()
-searchVar.trace_add("write", doSearch)
+searchVar.trace_add("write", scheduleSearch)
 
 searchBox = Entry(buttonFrame, textvariable=searchVar)
 searchBox.grid(row=0, column=3, sticky=E+W)
@@ -258,6 +511,7 @@ master.columnconfigure(0, weight=1)
 master.rowconfigure(0, weight=1)
 master.rowconfigure(1, weight=0)
 
-getAll()
+# query once the window is shown
+master.after(100, getAll)
 
 mainloop()
@@ -0,0 +1,257 @@
+"""
+Columnar snapshots of the mysqldump files in `backups/`, to use the data
+without a database server.
+
+`build` streams a dump (see dumpfile.py) into a directory with files for
+each column: integer and float columns as raw little-endian arrays, strings
+as their UTF-8 bytes one after another plus the offset of each of them, and
+a byte per row marking NULLs. `manifest.json` lists the tables, their
+columns and row counts, and is written last, so that a half written snapshot
+can't be opened.
+
+`load` memory-maps the columns with NumPy, so opening a snapshot only reads
+the manifest, and the data is read from the disk when used:
+
+    s = snapshot.load('snapshot')
+    people = s['person']
+    people['id'][:10], people['name'][5], people.nulls('name').sum()
+
+Usage:
+    python3 snapshot.py build ../backups/eoa18022021.sql snapshot
+    python3 snapshot.py info snapshot
+"""
+
+import os
+import re
+import sys
+import json
+import time
+
+import numpy as np
+
+import dumpfile
+
+MANIFEST = 'manifest.json'
+
+INT = '<i8'
+FLOAT = '<f8'
+STRING = 'str'
+
+"""
+Type of a column in the snapshot, by its definition in CREATE TABLE
+"""
+def columnType(definition):
+    if re.match(r'(tiny|small|medium|big)?int\b', definition, re.IGNORECASE):
+        return INT
+    if re.match(r'(float|double|decimal|real)\b', definition, re.IGNORECASE):
+        return FLOAT
+    return STRING
+
+def columnPath(directory, table, column, kind):
+    return os.path.join(directory, f'{table}.{column}.{kind}')
+
+class NumberWriter:
+    """
+    Appends the values of an integer or float column to its files
+    """
+    def __init__(self, directory, table, column, dtype):
+        self.dtype = dtype
+        self.data = open(columnPath(directory, table, column, 'data'), 'wb')
+        self.nulls = open(columnPath(directory, table, column, 'null'), 'wb')
+        self.values = []
+        self.nullFlags = bytearray()
+
+    def append(self, value):
+        self.nullFlags.append(value is None)
+        self.values.append(0 if value is None else value)
+
+    def flush(self):
+        np.array(self.values, dtype=self.dtype).tofile(self.data)
+        self.nulls.write(self.nullFlags)
+        self.values.clear()
+        self.nullFlags.clear()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.nulls.close()
+
+class StringWriter:
+    """
+    Appends the values of a string column to its files
+    """
+    def __init__(self, directory, table, column):
+        self.data = open(columnPath(directory, table, column, 'data'), 'wb')
+        self.offsets = open(columnPath(directory, table, column, 'offsets'), 'wb')
+        self.nulls = open(columnPath(directory, table, column, 'null'), 'wb')
+        self.end = 0
+        self.buffer = bytearray()
+        self.ends = [0]
+        self.nullFlags = bytearray()
+
+    def append(self, value):
+        self.nullFlags.append(value is None)
+        if value is not None:
+            self.buffer += value if isinstance(value, bytes) else str(value).encode()
+        self.ends.append(self.end + len(self.buffer))
+
+    def flush(self):
+        np.array(self.ends, dtype=INT).tofile(self.offsets)
+        self.data.write(self.buffer)
+        self.nulls.write(self.nullFlags)
+        self.end += len(self.buffer)
+        self.buffer.clear()
+        self.ends.clear()
+        self.nullFlags.clear()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.offsets.close()
+        self.nulls.close()
+
+"""
+Write a snapshot of a dump into a directory (created if needed)
+Only the rows of one INSERT statement are in memory at a time.
+Returns the manifest
+"""
+def build(dump, directory):
+    os.makedirs(directory, exist_ok=True)
+    manifestPath = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifestPath):
+        os.remove(manifestPath)
+
+    tables = {}
+    writers = {}
+    for kind, name, statement in dumpfile.read(dump):
+        if kind == 'table':
+            if name in writers:
+                for w in writers[name].values():
+                    w.close()
+            table = dumpfile.parseCreateTable(statement)
+            columns = {column: columnType(definition) for column, definition in table['columns']}
+            tables[name] = {'rows': 0, 'columns': columns, 'primary': table['primary']}
+            writers[name] = {column: StringWriter(directory, name, column) if t == STRING else NumberWriter(directory, name, column, t)
+                             for column, t in columns.items()}
+        elif kind == 'rows':
+            tableWriters = writers[name]
+            columns = dumpfile.insertColumns(statement) or list(tableWriters)
+            missing = [tableWriters[c] for c in tableWriters if c not in columns]
+            rowWriters = [tableWriters[c] for c in columns]
+            count = 0
+            for row in dumpfile.parseRows(statement):
+                for w, value in zip(rowWriters, row):
+                    w.append(value)
+                for w in missing:
+                    w.append(None)
+                count += 1
+            for w in tableWriters.values():
+                w.flush()
+            tables[name]['rows'] += count
+
+    for tableWriters in writers.values():
+        for w in tableWriters.values():
+            w.close()
+
+    manifest = {'source': os.path.basename(dump), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tables': tables}
+    with open(manifestPath + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifestPath + '.tmp', manifestPath)
+    return manifest
+
+def mapFile(path, dtype, count):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+class StringColumn:
+    """
+    The values of a string column, decoded when accessed
+    """
+    def __init__(self, offsets, data, nulls):
+        self.offsets = offsets
+        self.data = data
+        self.nulls = nulls
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self.nulls[i]:
+            return None
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+class Table:
+    """
+    A table of a snapshot; the columns are mapped when first used
+    """
+    def __init__(self, directory, name, info):
+        self.directory = directory
+        self.name = name
+        self.rows = info['rows']
+        self.types = info['columns']
+        self.primary = info['primary']
+        self.cache = {}
+
+    @property
+    def columns(self):
+        return list(self.types)
+
+    def nulls(self, column):
+        """Whether each value of the column is NULL"""
+        return mapFile(columnPath(self.directory, self.name, column, 'null'), np.bool_, self.rows)
+
+    def __getitem__(self, column):
+        """The column as a NumPy array (NULLs are 0), or a StringColumn"""
+        if column not in self.cache:
+            t = self.types[column]
+            if t == STRING:
+                data = columnPath(self.directory, self.name, column, 'data')
+                self.cache[column] = StringColumn(
+                    mapFile(columnPath(self.directory, self.name, column, 'offsets'), INT, self.rows + 1),
+                    mapFile(data, np.uint8, os.path.getsize(data)),
+                    self.nulls(column))
+            else:
+                self.cache[column] = mapFile(columnPath(self.directory, self.name, column, 'data'), t, self.rows)
+        return self.cache[column]
+
+class Snapshot:
+    """
+    The tables of a snapshot, by name
+    """
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.source = manifest['source']
+        self.created = manifest['created']
+        self.tables = {name: Table(directory, name, info) for name, info in manifest['tables'].items()}
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+def load(directory):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return Snapshot(directory, json.load(f))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'build':
+        start = time.perf_counter()
+        manifest = build(sys.argv[2], sys.argv[3])
+        print(f'{sum(t["rows"] for t in manifest["tables"].values())} rows in {len(manifest["tables"])} tables'
+              f' written in {time.perf_counter() - start:.2f} s')
+    elif len(sys.argv) == 3 and sys.argv[1] == 'info':
+        start = time.perf_counter()
+        s = load(sys.argv[2])
+        print(f'{s.source} (snapshot of {s.created}), opened in {(time.perf_counter() - start) * 1000:.1f} ms')
+        for name, table in s.tables.items():
+            print(f'  {name}: {table.rows} rows, ' + ', '.join(f'{c} ({t})' for c, t in table.types.items()))
+    else:
+        print(f'Usage: {sys.argv[0]} build DUMP DIRECTORY | info DIRECTORY')
+        sys.exit(1)
@@ -0,0 +1,316 @@
+"""
+Summary tables maintained by the Python tools, so that the listings on the
+site (and the tools themselves) don't have to aggregate over all of
+`contestant` every time.
+
+  * school_stats: participations, distinct students and podium places per
+    school
+  * person_stats: participations, podium places and the first and last year
+    of taking part per person, for the hall of fame (hof.php)
+  * full_subcontest: every subcontest with the names of its contest,
+    subject, type, year and age group (this used to be a view joining them
+    on every query, the rebuild replaces it)
+  * person_search: the words of every person's name, folded like in
+    personclusters.py, so that names can be searched by the beginnings of
+    their words with an index instead of scanning `person` with LIKE '%...%'
+
+The tools refresh only the rows affected by their changes, inside their own
+transactions. Until a table has been created, its refreshes are skipped (with
+a warning), as the rebuild computes all of it anyway; full_subcontest is not
+refreshed while it is still a view. To create the tables or
+recompute them from scratch, run:
+    python3 summaries.py rebuild
+
+The tools only refresh what they change themselves. None of them rename
+contests, subjects, types or age groups, or change the year of a contest, so
+after doing that by hand in the database, rebuild the tables that copy it:
+    python3 summaries.py rebuild full_subcontest person_stats
+"""
+
+import sys
+import logging
+
+from personclusters import foldName
+
+SCHOOL_STATS_DDL = """CREATE TABLE IF NOT EXISTS school_stats (
+  school_id int NOT NULL,
+  participations int NOT NULL,
+  students int NOT NULL,
+  place1 int NOT NULL,
+  place2 int NOT NULL,
+  place3 int NOT NULL,
+  PRIMARY KEY (school_id),
+  KEY idx_school_stats_participations (participations)
+)"""
+
+SCHOOL_STATS_SELECT = """SELECT school_id, COUNT(*), COUNT(DISTINCT person_id),
+    COUNT(CASE WHEN placement = 1 THEN 1 END),
+    COUNT(CASE WHEN placement = 2 THEN 1 END),
+    COUNT(CASE WHEN placement = 3 THEN 1 END)
+  FROM contestant"""
+
+PERSON_STATS_DDL = """CREATE TABLE IF NOT EXISTS person_stats (
+  person_id int NOT NULL,
+  participations int NOT NULL,
+  place1 int NOT NULL,
+  place2 int NOT NULL,
+  place3 int NOT NULL,
+  podiums int NOT NULL,
+  first_year int DEFAULT NULL,
+  last_year int DEFAULT NULL,
+  PRIMARY KEY (person_id),
+  KEY idx_person_stats_hof (participations, podiums, place1, place2, place3)
+)"""
+
+PERSON_STATS_SELECT = """SELECT co.person_id, COUNT(*),
+    COUNT(CASE WHEN co.placement = 1 THEN 1 END),
+    COUNT(CASE WHEN co.placement = 2 THEN 1 END),
+    COUNT(CASE WHEN co.placement = 3 THEN 1 END),
+    COUNT(CASE WHEN co.placement IN (1, 2, 3) THEN 1 END),
+    MIN(c.year), MAX(c.year)
+  FROM contestant co
+  LEFT JOIN subcontest sc ON sc.id = co.subcontest_id
+  LEFT JOIN contest c ON c.id = sc.contest_id"""
+
+FULL_SUBCONTEST_DDL = """CREATE TABLE IF NOT EXISTS full_subcontest (
+  sc_id int NOT NULL,
+  sc_name varchar(64) NOT NULL,
+  c_id int NOT NULL,
+  c_name varchar(64) NOT NULL,
+  s_id int DEFAULT NULL,
+  s_name varchar(64) DEFAULT NULL,
+  t_id int DEFAULT NULL,
+  t_name varchar(64) DEFAULT NULL,
+  y_id int DEFAULT NULL,
+  y_name varchar(64) DEFAULT NULL,
+  a_id int DEFAULT NULL,
+  a_name varchar(64) DEFAULT NULL,
+  PRIMARY KEY (sc_id),
+  KEY idx_full_subcontest_contest (c_id)
+) DEFAULT CHARSET=utf8"""
+
+# y_id is the starting year of the school year, y_name the school year
+# (e.g. 2019/2020) like in the year table the view used to join
+FULL_SUBCONTEST_SELECT = """SELECT sc.id, sc.name, c.id, c.name, s.id, s.name, t.id, t.name,
+    c.year, CONCAT(c.year, '/', c.year + 1), a.id, a.name
+  FROM subcontest sc
+  JOIN contest c ON c.id = sc.contest_id
+  LEFT JOIN subject s ON s.id = c.subject_id
+  LEFT JOIN type t ON t.id = c.type_id
+  LEFT JOIN age_group a ON a.id = sc.age_group_id"""
+
+PERSON_SEARCH_DDL = """CREATE TABLE IF NOT EXISTS person_search (
+  token varchar(64) NOT NULL,
+  person_id int NOT NULL,
+  PRIMARY KEY (token, person_id),
+  KEY idx_person_search_person (person_id)
+) DEFAULT CHARSET=utf8"""
+
+# people inserted into person_search per query by rebuildPersonSearch
+SEARCH_CHUNK_SIZE = 1000
+
+def execute(cur, query, params = ()):
+    logging.debug('Query: ' + repr(query) + ', ' + repr(params))
+    cur.execute(query, params)
+
+def inList(values):
+    return '(' + ', '.join(['%s'] * len(values)) + ')'
+
+"""
+'VIEW' or 'BASE TABLE' (None if there is no such table)
+"""
+def tableType(cur, name):
+    execute(cur, "SELECT table_type FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s", (name,))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+# summary tables known to exist, so that they are only checked once
+_created = set()
+
+"""
+Whether a summary table has been created (by the rebuild), so that it can be
+refreshed
+Creating it here would commit the transaction of the tool (MySQL commits
+before any CREATE TABLE), so a missing table is left for the rebuild. The
+same goes for full_subcontest while it is still the view it used to be: that
+is always up to date, and can't be written to anyway.
+"""
+def isCreated(cur, table):
+    if table in _created:
+        return True
+    if tableType(cur, table) == 'BASE TABLE':
+        _created.add(table)
+        return True
+    logging.warning(f'{table} is not a table yet, run "python3 summaries.py rebuild {table}"')
+    return False
+
+"""
+Get the distinct schools of the contestants of the given subcontests
+"""
+def subcontestSchoolIds(cur, subcontestIds):
+    subcontestIds = list(subcontestIds)
+    if not subcontestIds:
+        return set()
+    execute(cur, "SELECT DISTINCT school_id FROM contestant WHERE school_id IS NOT NULL AND subcontest_id IN " + inList(subcontestIds),
+            tuple(str(i) for i in subcontestIds))
+    return set(id for id, in cur)
+
+"""
+Get the distinct people taking part in the given subcontests
+"""
+def subcontestPersonIds(cur, subcontestIds):
+    subcontestIds = list(subcontestIds)
+    if not subcontestIds:
+        return set()
+    execute(cur, "SELECT DISTINCT person_id FROM contestant WHERE person_id IS NOT NULL AND subcontest_id IN " + inList(subcontestIds),
+            tuple(str(i) for i in subcontestIds))
+    return set(id for id, in cur)
+
+"""
+Get the distinct schools the given people have taken part from
+"""
+def personSchoolIds(cur, personIds):
+    personIds = [str(i) for i in personIds]
+    if not personIds:
+        return set()
+    execute(cur, "SELECT DISTINCT school_id FROM contestant WHERE school_id IS NOT NULL AND person_id IN " + inList(personIds),
+            tuple(personIds))
+    return set(id for id, in cur)
+
+"""
+Recompute school_stats for the given schools only
+Schools without contestants (or deleted ones) lose their row.
+"""
+def refreshSchoolStats(cur, schoolIds):
+    schoolIds = [str(i) for i in schoolIds if i is not None]
+    if not schoolIds or not isCreated(cur, 'school_stats'):
+        return
+    execute(cur, "DELETE FROM school_stats WHERE school_id IN " + inList(schoolIds), tuple(schoolIds))
+    execute(cur, "INSERT INTO school_stats " + SCHOOL_STATS_SELECT + " WHERE school_id IN " + inList(schoolIds) + " GROUP BY school_id",
+            tuple(schoolIds))
+
+def rebuildSchoolStats(cur):
+    execute(cur, SCHOOL_STATS_DDL)
+    execute(cur, "DELETE FROM school_stats")
+    execute(cur, "INSERT INTO school_stats " + SCHOOL_STATS_SELECT + " WHERE school_id IS NOT NULL GROUP BY school_id")
+
+"""
+Recompute person_stats for the given people only
+People without participations (or deleted ones) lose their row.
+"""
+def refreshPersonStats(cur, personIds):
+    personIds = [str(i) for i in personIds if i is not None]
+    if not personIds or not isCreated(cur, 'person_stats'):
+        return
+    execute(cur, "DELETE FROM person_stats WHERE person_id IN " + inList(personIds), tuple(personIds))
+    execute(cur, "INSERT INTO person_stats " + PERSON_STATS_SELECT + " WHERE co.person_id IN " + inList(personIds) + " GROUP BY co.person_id",
+            tuple(personIds))
+
+def rebuildPersonStats(cur):
+    execute(cur, PERSON_STATS_DDL)
+    execute(cur, "DELETE FROM person_stats")
+    execute(cur, "INSERT INTO person_stats " + PERSON_STATS_SELECT + " WHERE co.person_id IS NOT NULL GROUP BY co.person_id")
+
+"""
+Recompute full_subcontest for the given subcontests only
+Deleted subcontests lose their row. The names of their contest, subject, type
+and age group are copied as they are now; renaming those by hand needs a
+rebuild (see above).
+"""
+def refreshFullSubcontest(cur, subcontestIds):
+    subcontestIds = [str(i) for i in subcontestIds]
+    if not subcontestIds or not isCreated(cur, 'full_subcontest'):
+        return
+    execute(cur, "DELETE FROM full_subcontest WHERE sc_id IN " + inList(subcontestIds), tuple(subcontestIds))
+    execute(cur, "INSERT INTO full_subcontest " + FULL_SUBCONTEST_SELECT + " WHERE sc.id IN " + inList(subcontestIds),
+            tuple(subcontestIds))
+
+def rebuildFullSubcontest(cur):
+    if tableType(cur, 'full_subcontest') == 'VIEW':
+        execute(cur, "DROP VIEW full_subcontest")
+    execute(cur, FULL_SUBCONTEST_DDL)
+    execute(cur, "DELETE FROM full_subcontest")
+    execute(cur, "INSERT INTO full_subcontest " + FULL_SUBCONTEST_SELECT)
+
+"""
+The words of a name (or a search) as they are in person_search
+"""
+def searchTokens(name):
+    return set(foldName(name).split())
+
+"""
+Add people (a dictionary from id to name) to person_search, replacing what
+was there for them
+"""
+def indexPeople(cur, people):
+    if not people or not isCreated(cur, 'person_search'):
+        return
+    ids = [str(id) for id in people]
+    execute(cur, "DELETE FROM person_search WHERE person_id IN " + inList(ids), tuple(ids))
+    rows = [(token[:64], str(id)) for id, name in people.items() for token in searchTokens(name)]
+    if rows:
+        logging.debug(f'Indexing {len(people)} people ({len(rows)} tokens)')
+        cur.executemany("INSERT INTO person_search (token, person_id) VALUES (%s, %s)", rows)
+
+"""
+Remove (deleted) people from person_search
+"""
+def unindexPeople(cur, personIds):
+    personIds = [str(i) for i in personIds]
+    if personIds and isCreated(cur, 'person_search'):
+        execute(cur, "DELETE FROM person_search WHERE person_id IN " + inList(personIds), tuple(personIds))
+
+"""
+Remove those of the given people that no longer exist from person_search
+(e.g. after deleting the ones that don't take part in anything)
+"""
+def unindexDeletedPeople(cur, personIds):
+    personIds = [str(i) for i in personIds]
+    if personIds and isCreated(cur, 'person_search'):
+        execute(cur, "DELETE s FROM person_search s LEFT JOIN person p ON p.id = s.person_id"
+                     " WHERE s.person_id IN " + inList(personIds) + " AND p.id IS NULL", tuple(personIds))
+
+"""
+Find the people whose name has a word beginning with each of the words of
+`text` (the same query as name_search.php)
+Returns a list of (id, name)
+"""
+def searchPeople(cur, text):
+    words = sorted(searchTokens(text), key=len, reverse=True)
+    if not words:
+        return []
+    joins = ''.join(f' JOIN person_search s{i} ON s{i}.person_id = p.id AND s{i}.token LIKE %s' for i in range(len(words)))
+    execute(cur, "SELECT DISTINCT p.id, p.name FROM person p" + joins, tuple(w + '%' for w in words))
+    return cur.fetchall()
+
+def rebuildPersonSearch(cur):
+    execute(cur, PERSON_SEARCH_DDL)
+    execute(cur, "DELETE FROM person_search")
+    execute(cur, "SELECT id, name FROM person")
+    people = cur.fetchall()
+    for i in range(0, len(people), SEARCH_CHUNK_SIZE):
+        indexPeople(cur, dict(people[i:i + SEARCH_CHUNK_SIZE]))
+
+rebuilders = {
+    'school_stats': rebuildSchoolStats,
+    'person_stats': rebuildPersonStats,
+    'full_subcontest': rebuildFullSubcontest,
+    'person_search': rebuildPersonSearch,
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild' or any(t not in rebuilders for t in sys.argv[2:]):
+        print(f'Usage: {sys.argv[0]} rebuild [{"|".join(rebuilders)}...]')
+        sys.exit(1)
+
+    import db
+
+    conn = db.connection()
+    cur = conn.cursor()
+
+    for table in sys.argv[2:] or rebuilders:
+        print(f'Rebuilding {table}')
+        rebuilders[table](cur)
+        conn.commit()
+    print('Done')